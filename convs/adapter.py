@@ -3,12 +3,13 @@ import math
 from functools import partial
 from typing import List, Optional
 
-import timm
 import torch
 import torch.nn as nn
 from timm.models.layers import DropPath
 from timm.models.vision_transformer import PatchEmbed
 
+from utils.weight_registry import pretrained_state_dict, load_into
+
 
 class Adapter(nn.Module):
     def __init__(self, config=None):
@@ -307,35 +308,11 @@ class VisionTransformer(nn.Module):
 def vit_base_patch16_224_in21k(config=None):
     model = VisionTransformer(config=config)
 
-    checkpoint_model = timm.create_model('vit_base_patch16_224_in21k', pretrained=True, num_classes=0)
-    state_dict = checkpoint_model.state_dict()
-
-    # modify the checkpoint state dict to match the model
-    # first, split qkv weight into q, k, v
-    for key in list(state_dict.keys()):
-        if 'qkv.weight' in key:
-            qkv_weight = state_dict.pop(key)
-            q_weight = qkv_weight[:768]
-            k_weight = qkv_weight[768 : 768 * 2]
-            v_weight = qkv_weight[768 * 2 :]
-            state_dict[key.replace('qkv.weight', 'q_proj.weight')] = q_weight
-            state_dict[key.replace('qkv.weight', 'k_proj.weight')] = k_weight
-            state_dict[key.replace('qkv.weight', 'v_proj.weight')] = v_weight
-        elif 'qkv.bias' in key:
-            qkv_bias = state_dict.pop(key)
-            q_bias = qkv_bias[:768]
-            k_bias = qkv_bias[768 : 768 * 2]
-            v_bias = qkv_bias[768 * 2 :]
-            state_dict[key.replace('qkv.bias', 'q_proj.bias')] = q_bias
-            state_dict[key.replace('qkv.bias', 'k_proj.bias')] = k_bias
-            state_dict[key.replace('qkv.bias', 'v_proj.bias')] = v_bias
-    # second, modify the mlp.fc.weight to match fc.weight
-    for key in list(state_dict.keys()):
-        if 'mlp.fc' in key:
-            fc_weight = state_dict.pop(key)
-            state_dict[key.replace('mlp.', '')] = fc_weight
-
-    msg = model.load_state_dict(state_dict, strict=False)
+    # 本地注册目录中已拆分qkv、改名fc的权重(首次使用时转换), memmap零拷贝读取
+    state_dict = pretrained_state_dict('vit_base_patch16_224_in21k', layout='adapter',
+                                       root=getattr(config, 'weight_dir', None))
+
+    msg = load_into(model, state_dict, strict=False)
 
     # freeze all but the adapter
     for name, p in model.named_parameters():
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from convs.vpt import build_promptmodel
+from utils.ncm import sq_l2_distances
 
 
 class PPLoss(nn.Module):
@@ -123,13 +124,13 @@ class NCMLoss(nn.Module):
         self.temperature = temperature
         self.epsilon = epsilon
 
-    def forward(self, features, labels, prototypes=None):
+    def forward(self, features, labels, prototypes=None, proto_sq_norms=None):
         # 动态计算原型（若未提供）
         if prototypes is None:
             raise ValueError("prototypes is None")
 
-        # 计算特征与所有原型的距离 [B, C]
-        distances = torch.cdist(features, prototypes, p=2)  # 欧氏距离
+        # 计算特征与所有原型的距离 [B, C], matmul展开式, 可复用缓存的 ||p||^2
+        distances = sq_l2_distances(features, prototypes, proto_sq_norms).clamp(min=self.epsilon).sqrt()  # 欧氏距离
 
         # 将距离转换为概率（距离越小概率越高）
         logits = - distances / self.temperature  # [B, C]
@@ -138,14 +139,12 @@ class NCMLoss(nn.Module):
         # 新增对比正则化项
         C = prototypes.size(0)
         if C > 1:
-            # 生成标签对：所有不同类对组合
-            label_pairs = torch.combinations(torch.arange(C, device=prototypes.device), r=2)
-            anchor = prototypes[label_pairs[:, 0]]  # [num_pairs, D]
-            positive = prototypes[label_pairs[:, 1]]  # 实际为负样本（不同类）
+            # 所有不同类对组合的原型间距, 顺序与torch.combinations一致, 不再构造 [num_pairs, D] 的anchor/positive
+            pair_distances = torch.pdist(prototypes, p=2)  # [num_pairs]
 
             # 计算对比损失（增大负样本间距）
             margin = 10.0  # 目标最小间距
-            contrastive_loss = F.relu(margin - torch.norm(anchor - positive, dim=1)).mean()
+            contrastive_loss = F.relu(margin - pair_distances).mean()
         else:
             contrastive_loss = 0.0
 
@@ -206,7 +205,12 @@ class NCMLoss(nn.Module):
             prompt_pool,
             old_networks,
             current_outputs,
+            old_outputs=None,
     ):
+        """
+        old_outputs: 可选, 各旧teacher在当前batch上预先缓存的输出 [n_old, B, D] (utils.teacher_cache.TeacherCache),
+                     给定时不再逐个载入旧prompt/adapter做前向
+        """
         device = prototypes.device
         batch_size = current_inputs.size(0)
         num_classes = prototypes.size(0)
@@ -218,8 +222,9 @@ class NCMLoss(nn.Module):
         # 遍历所有任务
         for task_id, prompt in enumerate(prompt_pool):
             # 加载对应任务的prompt参数
-            old_networks.load_prompt(prompt)
-            old_networks.to(device)
+            if old_outputs is None:
+                old_networks.load_prompt(prompt)
+                old_networks.to(device)
 
             # 获取该任务的类索引范围
             task_class_indices = classes_per_task[task_id]
@@ -230,7 +235,7 @@ class NCMLoss(nn.Module):
             task_prototypes = prototypes[start_idx:end_idx]
 
             # 计算相似度（与eval_accuracy完全一致）
-            outputs = old_networks(current_inputs)  # [B, D]
+            outputs = old_networks(current_inputs) if old_outputs is None else old_outputs[task_id]  # [B, D]
             distances = torch.cdist(outputs, task_prototypes, p=2)  # [B, num_task_classes]
             similarities = - distances / self.temperature
 
@@ -291,7 +296,12 @@ class NCMLoss(nn.Module):
             adapter_pool,
             old_networks,
             current_outputs,
+            old_outputs=None,
     ):
+        """
+        old_outputs: 可选, 各旧teacher在当前batch上预先缓存的输出 [n_old, B, D] (utils.teacher_cache.TeacherCache),
+                     给定时不再逐个载入旧prompt/adapter做前向
+        """
         device = prototypes.device
         batch_size = current_inputs.size(0)
         num_classes = prototypes.size(0)
@@ -303,9 +313,10 @@ class NCMLoss(nn.Module):
         # 遍历所有任务
         for task_id, adapter in enumerate(adapter_pool):
             # 加载对应任务的prompt参数
-            # old_networks.load_prompt(adapter)
-            old_networks.backbone.cur_adapter = adapter
-            old_networks.to(device)
+            if old_outputs is None:
+                # old_networks.load_prompt(adapter)
+                old_networks.backbone.cur_adapter = adapter
+                old_networks.to(device)
 
             # 获取该任务的类索引范围
             task_class_indices = classes_per_task[task_id]
@@ -316,7 +327,7 @@ class NCMLoss(nn.Module):
             task_prototypes = prototypes[start_idx:end_idx]
 
             # 计算相似度（与eval_accuracy完全一致）
-            outputs = old_networks(current_inputs)  # [B, D]
+            outputs = old_networks(current_inputs) if old_outputs is None else old_outputs[task_id]  # [B, D]
             distances = torch.cdist(outputs, task_prototypes, p=2)  # [B, num_task_classes]
             similarities = - distances / self.temperature
 
@@ -1,22 +1,22 @@
-import timm
 import torch
 import torch.nn as nn
 from timm.models.vision_transformer import VisionTransformer, PatchEmbed
 
+from utils.weight_registry import pretrained_state_dict, load_into
+
 def build_promptmodel(modelname='vit_base_patch16_224_in21k', Prompt_Token_num=5, VPT_type="Shallow", args=None, new_classes=5,
-                      frozen_heads=True, ):
+                      frozen_heads=True, multi_prompt=False):
 
     # VPT_type = "Deep" / "Shallow"
-    basic_model = timm.create_model(modelname, pretrained=True)
-    model = VPT_ViT(Prompt_Token_num=Prompt_Token_num, VPT_type=VPT_type, num_classes=new_classes,
-                    frozen_heads=frozen_heads)
+    # multi_prompt: 返回共享冻结ViT权重的 MultiPromptVPT_ViT, 旧prompt通过 prompt_view 前向
+    model_class = MultiPromptVPT_ViT if multi_prompt else VPT_ViT
+    model = model_class(Prompt_Token_num=Prompt_Token_num, VPT_type=VPT_type, num_classes=new_classes,
+                        frozen_heads=frozen_heads)
 
-    # drop head.weight and head.bias
-    basicmodeldict = basic_model.state_dict()
-    basicmodeldict.pop('head.weight')
-    basicmodeldict.pop('head.bias')
+    # 本地注册目录中的预训练权重(不含head.weight和head.bias), memmap零拷贝读取
+    basicmodeldict = pretrained_state_dict(modelname, root=args.get("weight_dir") if args is not None else None)
 
-    model.load_state_dict(basicmodeldict, False)    # strict=True: missing Prompt_tokens、head.bias、head.weight
+    load_into(model, basicmodeldict, strict=False)    # strict=True: missing Prompt_tokens、head.bias、head.weight
 
     if not frozen_heads:
         model.head = torch.nn.Identity()
@@ -100,7 +100,7 @@ class VPT_ViT(VisionTransformer):
             print('shape of model given prompt', prompt_state_dict['Prompt_Tokens'].shape)
             print('')
 
-    def forward_features(self, x):
+    def _embed_tokens(self, x):
         x = self.patch_embed(x)
         # print(x.shape,self.pos_embed.shape)
         cls_token = self.cls_token.expand(x.shape[0], -1, -1)
@@ -108,26 +108,26 @@ class VPT_ViT(VisionTransformer):
         # concatenate CLS token
         x = torch.cat((cls_token, x), dim=1)
         x = self.pos_drop(x + self.pos_embed)
+        return x
 
+    def _forward_blocks(self, x, prompt_tokens):
+        """
+        Args:
+            x: [B, N, D] embed后的tokens
+            prompt_tokens: [B, L, Prompt_Token_num, D] 每个样本使用的prompt(可由 [1, ...] expand而来), Shallow时L=1
+        """
+        Prompt_Token_num = prompt_tokens.shape[2]
         if self.VPT_type == "Deep":
-
-            Prompt_Token_num = self.Prompt_Tokens.shape[1]
-
             for i in range(len(self.blocks)):
-                # concatenate Prompt_Tokens
-                Prompt_Tokens = self.Prompt_Tokens[i].unsqueeze(0)
-                # firstly concatenate
-                x = torch.cat((x, Prompt_Tokens.expand(x.shape[0], -1, -1)), dim=1)
+                # firstly concatenate Prompt_Tokens
+                x = torch.cat((x, prompt_tokens[:, i]), dim=1)
                 num_tokens = x.shape[1]
                 # lastly remove, a genius trick
                 x = self.blocks[i](x)[:, :num_tokens - Prompt_Token_num]
 
         else:  # self.VPT_type == "Shallow"
-            Prompt_Token_num = self.Prompt_Tokens.shape[1]
-
             # concatenate Prompt_Tokens
-            Prompt_Tokens = self.Prompt_Tokens.expand(x.shape[0], -1, -1)
-            x = torch.cat((x, Prompt_Tokens), dim=1)
+            x = torch.cat((x, prompt_tokens[:, 0]), dim=1)
             num_tokens = x.shape[1]
             # Sequentially process
             x = self.blocks(x)[:, :num_tokens - Prompt_Token_num]
@@ -135,6 +135,11 @@ class VPT_ViT(VisionTransformer):
         x = self.norm(x)
         return x
 
+    def forward_features(self, x):
+        x = self._embed_tokens(x)
+        prompt_tokens = self.Prompt_Tokens.unsqueeze(0).expand(x.shape[0], -1, -1, -1)
+        return self._forward_blocks(x, prompt_tokens)
+
     def forward(self, x):
         x = self.forward_features(x)
         x = self.fc_norm(x[:, 0, :])
@@ -147,4 +152,94 @@ class VPT_ViT(VisionTransformer):
     def forward_features_(self, x):
         x = self.forward_features(x)
         x = self.fc_norm(x[:, 0, :])
-        return x
\ No newline at end of file
+        return x
+
+
+class MultiPromptVPT_ViT(VPT_ViT):
+    """
+    一份冻结的ViT权重 + 多个prompt: Prompt_Tokens为当前训练的prompt, frozen_prompts为旧prompt(不求梯度)
+    旧网络不再是第二个完整的VPT_ViT, 而是 prompt_view 返回的视图; forward_prompts 把同一batch在多个prompt下的
+    前向沿batch维拼接为一次前向, patch embedding只计算一次
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.frozen_prompts = []
+
+    def set_frozen_prompt(self, prompt_id, prompt_state_dict):
+        # clone: 避免与仍在训练的Prompt_Tokens共享存储
+        prompt = prompt_state_dict['Prompt_Tokens'].detach().clone()
+        if prompt.shape != self.Prompt_Tokens.shape:
+            raise ValueError("Prompt shape mismatch: {} vs {}".format(tuple(prompt.shape), tuple(self.Prompt_Tokens.shape)))
+        while len(self.frozen_prompts) <= prompt_id:
+            self.frozen_prompts.append(None)
+        self.frozen_prompts[prompt_id] = prompt
+
+    def prompt_view(self, prompt_id=0):
+        return FrozenPromptView(self, prompt_id)
+
+    def _prompt(self, prompt_id):
+        if prompt_id is None:
+            return self.Prompt_Tokens
+        return self.frozen_prompts[prompt_id].to(self.Prompt_Tokens.device, self.Prompt_Tokens.dtype)
+
+    def forward_prompts(self, x, prompt_ids):
+        """
+        Args:
+            x: [B, C, H, W]
+            prompt_ids: None代表当前的Prompt_Tokens, 整数i代表frozen_prompts[i]
+        Returns:
+            [len(prompt_ids), B, D], 与逐个prompt调用forward的结果一致
+        """
+        num_prompts, batch_size = len(prompt_ids), x.shape[0]
+        tokens = self._embed_tokens(x).repeat(num_prompts, 1, 1)
+        prompts = torch.stack([self._prompt(prompt_id) for prompt_id in prompt_ids])
+        x = self._forward_blocks(tokens, prompts.repeat_interleave(batch_size, dim=0))
+        x = self.fc_norm(x[:, 0, :])
+
+        if not self.frozen_heads:
+            x = self.head(x)
+
+        return x.view(num_prompts, batch_size, -1)
+
+
+class FrozenPromptView(object):
+    """
+    共享模型在frozen_prompts[prompt_id]下的前向, 用法与旧的 _old_network (VPT_ViT) 一致:
+    load_prompt 只替换该冻结prompt, to/eval/train作用于共享模型
+    named_parameters/num_features 供 EmbeddingCache 计算指纹: 其中的Prompt_Tokens为该视图的冻结prompt
+    """
+
+    def __init__(self, model, prompt_id):
+        self.model = model
+        self.prompt_id = prompt_id
+
+    def __call__(self, x):
+        return self.model.forward_prompts(x, [self.prompt_id])[0]
+
+    @property
+    def training(self):
+        return self.model.training
+
+    @property
+    def num_features(self):
+        return self.model.num_features
+
+    def named_parameters(self):
+        for name, param in self.model.named_parameters():
+            yield name, self.model._prompt(self.prompt_id) if name == 'Prompt_Tokens' else param
+
+    def load_prompt(self, prompt_state_dict):
+        self.model.set_frozen_prompt(self.prompt_id, prompt_state_dict)
+
+    def to(self, device):
+        self.model.to(device)
+        return self
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def train(self, mode=True):
+        self.model.train(mode)
+        return self
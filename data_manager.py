@@ -1,3 +1,5 @@
+import hashlib
+import torch
 import torchvision.transforms as transforms
 from torch.utils.data import Dataset
 from PIL import Image
@@ -5,35 +7,55 @@ import numpy as np
 
 import utils.toolkits as toolkits
 from utils.toolkits import seed_set
+from utils.image_cache import DecodedImageCache, PreprocessedImageCache, find_resize, split_deterministic, data_digest
+from utils.batch_augment import BatchTransform, report_speed
 
 seed_set()
 
 
 # 封装数据集
 class DummyDataset(Dataset):
-    def __init__(self, images, labels, trsf, use_path=False):
-        assert len(images) == len(labels), "Data size error!"
+    def __init__(self, images, labels, trsf, use_path=False, sample_ids=None, image_cache=None, tensor_cache=None):
+        # sample_ids为None时, images即为本数据集的全部样本;
+        # 否则images为DataManager中按类别连续存放的完整数组, sample_ids为其中的行下标(零拷贝)
+        if sample_ids is None:
+            assert len(images) == len(labels), "Data size error!"
+            sample_ids = np.arange(len(labels))
+        assert len(sample_ids) == len(labels), "Data size error!"
         self.images = images
         self.labels = labels
+        self.sample_ids = sample_ids
         self.trsf = trsf
         self.use_path = use_path
+        # 解码图片缓存(DecodedImageCache), 按sample_id索引, 命中时无需打开文件与JPEG解码
+        self.image_cache = image_cache
+        # 预处理结果缓存(PreprocessedImageCache), 此时trsf只包含ToTensor之后的张量操作
+        self.tensor_cache = tensor_cache
 
     def __len__(self):
-        return len(self.images)
+        return len(self.labels)
 
     def __getitem__(self, idx):
-        if self.use_path:
-            path = self.images[idx]
-            with open(path, 'rb') as f:
-                img = Image.open(f)
-                img = img.convert('RGB')
-            image = self.trsf(img)
+        sample_id = self.sample_ids[idx]
+        if self.tensor_cache is not None:
+            image = self.trsf(self.tensor_cache.fetch(sample_id, self.load_image))
         else:
-            image = self.trsf(Image.fromarray(self.images[idx]))
+            image = self.trsf(self.load_image(sample_id))
         label = self.labels[idx]
 
         return idx, image, label
 
+    def load_image(self, sample_id):
+        if self.image_cache is not None:
+            return Image.fromarray(self.image_cache[sample_id])
+        if self.use_path:
+            path = self.images[sample_id]
+            with open(path, 'rb') as f:
+                img = Image.open(f)
+                img = img.convert('RGB')
+            return img
+        return Image.fromarray(self.images[sample_id])
+
 
 # 数据管理
 class DataManager(object):
@@ -54,8 +76,8 @@ class DataManager(object):
         idata.download_data()
 
         # 传递idata中的data与targets
-        self._train_data, self._train_targets = idata.train_data, idata.train_targets
-        self._test_data, self._test_targets = idata.test_data, idata.test_targets
+        self._train_data, self._train_targets = idata.train_data, np.asarray(idata.train_targets)
+        self._test_data, self._test_targets = idata.test_data, np.asarray(idata.test_targets)
         self.use_path = idata.use_path
 
         # Transforms
@@ -73,9 +95,63 @@ class DataManager(object):
             order = idata.class_order
             self._class_order = order
 
-        # 重新排序targets
-        self.train_targets = [self._class_order.index(x) for x in self._train_targets]
-        self.test_targets = [self._class_order.index(x) for x in self._test_targets]
+        # 重新排序targets, 向量化查表代替 self._class_order.index(x)
+        num_classes = max(len(self._class_order), int(self._train_targets.max()) + 1,
+                          int(self._test_targets.max()) + 1)
+        order_lookup = np.full(num_classes, -1, dtype=np.int64)
+        order_lookup[np.asarray(self._class_order, dtype=np.int64)] = np.arange(len(self._class_order))
+
+        # 构建CSR索引, 并将数据按类别连续存放, 之后get_dataset只需切片/下标数组
+        train_order, self._train_offsets = toolkits.build_class_index(self._train_targets, num_classes)
+        test_order, self._test_offsets = toolkits.build_class_index(self._test_targets, num_classes)
+        self._train_data, self._train_targets = self._train_data[train_order], self._train_targets[train_order]
+        self._test_data, self._test_targets = self._test_data[test_order], self._test_targets[test_order]
+
+        self.train_targets = order_lookup[self._train_targets]
+        self.test_targets = order_lookup[self._test_targets]
+
+        # 可选: 批量张量空间增强, loader只拼接原始分辨率uint8图片, crop/resize/flip/normalize在设备上按batch完成
+        # 仅支持尺寸一致的内存型数据集(CIFAR), 路径型数据集尺寸不一无法直接拼接
+        self._batch_augment = self.args.get("batch_augment", False)
+        if self._batch_augment and self.use_path:
+            print('batch_augment only supports in-memory datasets, fall back to PIL transforms')
+            self._batch_augment = False
+        if self._batch_augment:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            report_speed(self._train_data[:512], [*self._train_trsf, *self._common_trsf], device=device,
+                         words='Batch augment (train)')
+
+        # 可选: 测试集确定性预处理(Resize/CenterCrop)结果的持久化缓存, mode="test"/"flip"共用
+        # 旧类别的测试样本只在首次出现时预处理一次, 之后的任务/运行直接从memmap读取
+        self._test_tensor_cache = None
+        split = split_deterministic(self._test_trsf)
+        if self.args.get("test_tensor_cache", False) and split is not None:
+            pre_list, post_list, shape = split
+            key = data_digest(self._test_data, extra=repr(pre_list))
+            self._test_tensor_cache = PreprocessedImageCache(self.args.get("cache_dir", "./cache"), key,
+                                                             len(self._test_data), shape,
+                                                             transforms.Compose(pre_list))
+            self._test_post_trsf = post_list
+
+        # 可选: embedding缓存, 数据集内容摘要在这里计算一次, get_dataset中再与transforms组合为缓存键
+        self._data_digests = None
+        if self.args.get("embedding_cache", False):
+            self._data_digests = {"train": data_digest(self._train_data), "test": data_digest(self._test_data)}
+
+        # 多worker加载时, 内存型数据集(CIFAR)放入共享内存, 避免每个worker各拷贝一份
+        if not self.use_path and self.args.get("num_workers", 0) > 0:
+            self._train_data = toolkits.share_array(self._train_data)
+            self._test_data = toolkits.share_array(self._test_data)
+
+        # 可选: 路径型数据集的解码图片缓存, 按测试resize分辨率解码一次后memmap共享
+        self._train_image_cache, self._test_image_cache = None, None
+        if self.use_path and self.args.get("image_cache", False):
+            size, interpolation = find_resize(self._test_trsf)
+            size = size if size is not None else 256
+            interpolation = interpolation if interpolation is not None else Image.BICUBIC
+            cache_dir = self.args.get("cache_dir", "./cache")
+            self._train_image_cache = DecodedImageCache(cache_dir, self._train_data, size, interpolation)
+            self._test_image_cache = DecodedImageCache(cache_dir, self._test_data, size, interpolation)
 
     # task中包含class数目
     def get_task_size(self, task_id):
@@ -84,40 +160,60 @@ class DataManager(object):
 
     def get_dataset(self, indices, source, mode):
         if source == "train":
-            x, y = self._train_data, self._train_targets
+            x, y, offsets = self._train_data, self._train_targets, self._train_offsets
+            image_cache = self._train_image_cache
         elif source == "test":
-            x, y = self._test_data, self._test_targets
+            x, y, offsets = self._test_data, self._test_targets, self._test_offsets
+            image_cache = self._test_image_cache
         else:
             raise ValueError("Unknown data source {}.".format(source))
 
         if mode == "train":
-            trsf = transforms.Compose([*self._train_trsf, *self._common_trsf])
+            trsf_list = [*self._train_trsf, *self._common_trsf]
         elif mode == "flip":
-            trsf = transforms.Compose([
+            trsf_list = [
                 *self._test_trsf,
                 transforms.RandomHorizontalFlip(p=1.0),
                 *self._common_trsf,
-            ])
+            ]
         elif mode == "test":
-            trsf = transforms.Compose([*self._test_trsf, *self._common_trsf])
+            trsf_list = [*self._test_trsf, *self._common_trsf]
         elif mode == "strong":
-            trsf = transforms.Compose([*self._strong_trsf, *self._common_trsf])
+            trsf_list = [*self._strong_trsf, *self._common_trsf]
         else:
             raise ValueError("Unknown mode {}.".format(mode))
-
-        # 构建数据包
-        data, targets = [], []
-        for idx in indices:
-            low_range = idx
-            high_range = idx + 1
-            idxes = np.where(np.logical_and(y >= low_range, y < high_range))[0]
-            # print('len(idxes)', len(idxes))
-
-            class_data = x[idxes]
-            class_targets = y[idxes]
-            data.append(class_data)
-            targets.append(class_targets)
-        data, targets = np.concatenate(data), np.concatenate(targets)
-
-        return DummyDataset(data, targets, trsf, self.use_path)
+        trsf = transforms.Compose(trsf_list)
+
+        # 解码图片缓存已缩放到测试resize分辨率, 只用于确定性模式(test/flip);
+        # train/strong的RandomResizedCrop等随机增强仍从原始分辨率的图片裁剪, 保持训练输入分布不变
+        if mode not in ("test", "flip"):
+            image_cache = None
+
+        # 测试集的test/flip模式: 确定性部分从缓存读取, 只执行ToTensor之后的张量操作
+        tensor_cache = None
+        if source == "test" and mode in ("test", "flip") and self._test_tensor_cache is not None:
+            tensor_cache = self._test_tensor_cache
+            flip = [transforms.RandomHorizontalFlip(p=1.0)] if mode == "flip" else []
+            trsf = transforms.Compose([*self._test_post_trsf, *flip, *self._common_trsf])
+
+        # 批量增强模式: 样本只转为uint8张量, 由build_dataloader在设备上执行batch_trsf
+        batch_trsf = BatchTransform.from_transforms(trsf_list) if self._batch_augment else None
+        if batch_trsf is not None:
+            trsf = transforms.PILToTensor()
+            tensor_cache = None
+
+        # 构建数据包: 由CSR索引直接得到行下标, 数据本身不拷贝
+        rows = toolkits.gather_class_rows(offsets, indices)
+        targets = y[rows]
+
+        dataset = DummyDataset(x, targets, trsf, self.use_path, sample_ids=rows, image_cache=image_cache,
+                               tensor_cache=tensor_cache)
+        dataset.batch_trsf = batch_trsf
+
+        # 只有确定性模式的输出可以缓存embedding, 键为 (数据集内容, source, mode, transforms)
+        dataset.embedding_key = None
+        if self._data_digests is not None and mode in ("test", "flip"):
+            trsf_digest = hashlib.sha1(f'{repr(trsf_list)}-{batch_trsf is not None}'.encode()).hexdigest()[:8]
+            dataset.embedding_key = f'{self._data_digests[source]}_{source}_{mode}_{trsf_digest}'
+        return dataset
 
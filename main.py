@@ -1,6 +1,9 @@
 from data_manager import DataManager
 from utils.toolkits import seed_set, load_json
 import utils.toolkits as toolkits
+from utils.metrics import TaskAccuracyMatrix
+import os
+import time
 
 seed_set()
 
@@ -52,11 +55,20 @@ def main():
     # 初始化模型
     model = toolkits.get_model(model_name=args["model_name"], args=args)
 
+    # 跨任务准确率矩阵, 由每个任务测试时保留的逐样本预测得到, 不额外前向
+    task_metrics = TaskAccuracyMatrix(data_manager._increments)
+    metrics_path = os.path.join(args.get("metrics_dir", "./logs"),
+                                f'{args["model_name"]}_{args["dataset"]}_{time.strftime("%Y%m%d-%H%M%S")}.json')
+
     # 执行增量学习任务
     for task in range(len(data_manager._increments)):
         print(f'Here Comes Task{task}', '*'*50)
         model.incremental_train(data_manager)
         model.eval_accuracy(words=f'{task}')
+        if getattr(model, 'eval_meter', None) is not None:
+            row = task_metrics.record(task, *model.eval_meter.predictions())
+            print('per-task accuracy:', ' '.join(f'{acc:.2f}' for acc in row[:task + 1]))
+            task_metrics.save(metrics_path)
         # model.watch_cosine_similarity()
         model.after_task()
 
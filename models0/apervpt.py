@@ -6,13 +6,13 @@ from torch.serialization import load
 from tqdm import tqdm
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 import timm
 from collections import OrderedDict
 from transformers import ViTForImageClassification
 
 from .base import BaseLeaner
 from convs.vpt import build_promptmodel
+import utils.toolkits as toolkits
 
 class Learner(BaseLeaner):
     def __init__(self, args):
@@ -31,13 +31,13 @@ class Learner(BaseLeaner):
         test_indices = np.arange(0, self._total_classes)
 
         train_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="train", )
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader = toolkits.build_dataloader(train_dataset, self.args, batch_size=batch_size, shuffle=True)
 
         test_dataset = data_manager.get_dataset(indices=test_indices, source="test", mode="test")
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+        self.test_loader = toolkits.build_dataloader(test_dataset, self.args, batch_size=batch_size, shuffle=False)
 
         train_dataset_for_protonet = data_manager.get_dataset(indices=train_indices, source="train", mode="test", )
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader_for_protonet = toolkits.build_dataloader(train_dataset_for_protonet, self.args, batch_size=batch_size, shuffle=True)
 
         # 只研究前三个数据包
         if self._known_classes == 0:
@@ -113,10 +113,8 @@ class Learner(BaseLeaner):
             inputs = inputs.to(self._device)
             with torch.no_grad():
                 outputs = self._network.forward(inputs)
-                for _, test_output in enumerate(outputs):
-                    value, predict = torch.max(test_output, dim=0)
-                    y_pred.append([predict])
-                    y_true.append(targets[_].item())
+                y_pred.extend(outputs.argmax(dim=1, keepdim=True).tolist())
+                y_true.extend(targets.tolist())
 
         return y_pred, y_true
 
@@ -127,10 +125,8 @@ class Learner(BaseLeaner):
             targets = targets - self._known_classes
             with torch.no_grad():
                 outputs = self._network.forward(inputs)
-                for _, test_output in enumerate(outputs):
-                    value, predict = torch.max(test_output, dim=0)
-                    y_pred.append([predict])
-                    y_true.append(targets[_].item())
+                y_pred.extend(outputs.argmax(dim=1, keepdim=True).tolist())
+                y_true.extend(targets.tolist())
 
         return y_pred, y_true
 
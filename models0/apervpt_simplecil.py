@@ -6,13 +6,14 @@ from torch.serialization import load
 from tqdm import tqdm
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 import timm
 from collections import OrderedDict
 from transformers import ViTForImageClassification
 
 from .base import BaseLeaner
 from convs.vpt import build_promptmodel
+import utils.toolkits as toolkits
+from utils.ncm import NCMClassifier
 
 class Learner(BaseLeaner):
     def __init__(self, args):
@@ -21,6 +22,8 @@ class Learner(BaseLeaner):
         self.args = args
         self._network_prompt = build_promptmodel(modelname="vit_base_patch16_224_in21k", Prompt_Token_num=self.args["Prompt_Token_num"],
                                                  VPT_type=self.args["VPT_type"], args=self.args, new_classes=5)
+        # L2距离倒数取top-2; 多个prompt时取top-1分数最高的prompt的预测
+        self.classifier = NCMClassifier(metric='inverse', top_num=2)
 
     def incremental_train(self, data_manager):
         self._cur_task = self._cur_task + 1
@@ -32,13 +35,13 @@ class Learner(BaseLeaner):
         test_indices = np.arange(0, self._total_classes)
 
         train_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="train", )
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader = toolkits.build_dataloader(train_dataset, self.args, batch_size=batch_size, shuffle=True)
 
         test_dataset = data_manager.get_dataset(indices=test_indices, source="test", mode="test")
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+        self.test_loader = toolkits.build_dataloader(test_dataset, self.args, batch_size=batch_size, shuffle=False)
 
         train_dataset_for_protonet = data_manager.get_dataset(indices=train_indices, source="train", mode="test", )
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader_for_protonet = toolkits.build_dataloader(train_dataset_for_protonet, self.args, batch_size=batch_size, shuffle=True)
 
         # 只研究前三个数据包
         if self._known_classes == 0:
@@ -62,33 +65,11 @@ class Learner(BaseLeaner):
             self.train_vpt()
             self._network.eval()
 
-        # 推理
-        embedding_list = []
-        label_list = []
-        with torch.no_grad():
-            for i, batch in enumerate(tqdm(self.train_loader_for_protonet)):
-                (_, data, label) = batch
-                data = data.to(self._device)
-                # label = label.to(self._device)
-
-                # 获取proto的核心, model.convnet(), 来自BaseNet类
-                embedding = self._network.forward_features_(data)
-                # print('embedding.shape', embedding.shape)
-                embedding_list.append(embedding.cpu())
-                label_list.append(label.cpu())
-        embedding_list = torch.cat(embedding_list, dim=0)
-        label_list = torch.cat(label_list, dim=0)
-
-        # NCM, 对class’s features取mean
-        class_list = np.unique(label_list)
-        feature_proto_list = []
-        for class_index in class_list:
-            # print('Replacing...',class_index)
-            data_index = (label_list == class_index).nonzero().squeeze(-1)
-            embeddings = embedding_list[data_index]
-            proto = embeddings.mean(0)
-            # print('proto_dim:', proto.shape)
-            feature_proto_list.append(proto)
+        # 推理, 开启embedding_cache时按prompt哈希缓存特征
+        # NCM, 对class’s features取mean, 按类别流式累加
+        feature_proto_list = toolkits.get_protos_with_tqdm(
+            self.train_loader_for_protonet, self._device, self._network, forward=self._network.forward_features_,
+            cache=self.embedding_cache, backbone_id="vit_base_patch16_224_in21k")
 
         # 传递proto_list
         if self._known_classes == 0:
@@ -155,89 +136,39 @@ class Learner(BaseLeaner):
 
     def eval_task(self,):
         y_pred, y_true = [], []
+        prototypes = torch.stack(self.feature_proto_list).to(self._device)
         for _, (_, inputs, targets) in enumerate(tqdm(self.test_loader)):
             inputs = inputs.to(self._device)
             with torch.no_grad():
-                # 初始化一个列表来存储每个输出的最佳预测和对应的value
-                best_predicts = [None] * len(inputs)
-                best_values = [-float('inf')] * len(inputs)
+                # 记录每个样本在各prompt下的最佳预测及其top-1分数
+                best_predicts = torch.full((len(inputs), self.classifier.top_num), -1, dtype=torch.long, device=self._device)
+                best_values = torch.full((len(inputs),), -float('inf'), device=self._device)
 
                 for prompt_tokens in self.prompt_token_list:
                     self._network_prompt.load_prompt(prompt_tokens)
                     self._network_prompt.to(self._device)
                     outputs = self._network_prompt.forward_features_(inputs)
+                    values, predicts = self.classifier.topk(outputs, prototypes)
 
-                    for idx, test_output in enumerate(outputs):
-                        predict, value = self.classify_with_proto_prompt(test_output, proto_list=self.feature_proto_list)
+                    # 如果当前value大于已记录的最大value，则更新记录
+                    better = values[:, 0] > best_values
+                    best_values = torch.where(better, values[:, 0], best_values)
+                    best_predicts = torch.where(better.unsqueeze(1), predicts, best_predicts)
 
-                        # 如果当前value大于已记录的最大value，则更新记录
-                        if value > best_values[idx]:
-                            best_values[idx] = value
-                            best_predicts[idx] = predict
-
-                # 将最佳预测添加到y_pred列表中，并将对应的target添加到y_true列表中
-                for idx, predict in enumerate(best_predicts):
-                    # print('predict:', predict[0])
-                    y_pred.append(predict)
-                    y_true.append(targets[idx].item())
+                y_pred.extend(best_predicts.tolist())
+                y_true.extend(targets.tolist())
 
         return y_pred, y_true
 
     def eval_cur_task_on_train_loader(self, train_loader):
         y_pred, y_true = [], []
+        prototypes = torch.stack(self.feature_proto_list[self._known_classes : self._total_classes]).to(self._device)
         for _, (_, inputs, targets) in enumerate(tqdm(train_loader)):
             inputs = inputs.to(self._device)
             with torch.no_grad():
                 outputs = self._network.forward_features_(inputs)
-
-                for _, test_output in enumerate(outputs):
-                    predict = self.classify_with_proto(test_output, proto_list=self.feature_proto_list[self._known_classes : self._total_classes])
-                    predict = [predict[0] + self._known_classes]
-                    # print('predict:', predict)
-                    y_pred.append(predict)
-                    y_true.append(targets[_].item())
+                predicts = self.classifier.predict(outputs, prototypes)[:, :1] + self._known_classes
+                y_pred.extend(predicts.tolist())
+                y_true.extend(targets.tolist())
 
         return y_pred, y_true
-
-    def classify_with_proto(self, test_output, proto_list):
-        top_num = 2
-        test_output = test_output.cpu()
-
-        # SimpleCIL分类
-        test_img_distance_coordinate_incre = []
-        for i in range(len(proto_list)):
-            # L2距离
-            distance = torch.sum((test_output - proto_list[i]) ** 2)
-            test_img_distance_coordinate_incre.append(1 / distance)
-
-        test_img_distance_coordinate_incre = torch.tensor(test_img_distance_coordinate_incre)
-        # print('test_img_distance_coordinate_incre', test_img_distance_coordinate_incre)
-
-        # 如果SimpleCIL分类拥有较高置信度
-        value_, index_ = torch.topk(test_img_distance_coordinate_incre, k=top_num, dim=0, largest=True, sorted=True)
-        test_img_coordinate_incre = index_.numpy().tolist()
-
-        predict = test_img_coordinate_incre
-
-        return predict
-
-    def classify_with_proto_prompt(self, test_output, proto_list):
-        top_num = 2
-        test_output = test_output.cpu()
-
-        # SimpleCIL分类
-        test_img_distance_coordinate_incre = []
-        for i in range(len(proto_list)):
-            # L2距离
-            distance = torch.sum((test_output - proto_list[i]) ** 2)
-            test_img_distance_coordinate_incre.append(1 / distance)
-
-        test_img_distance_coordinate_incre = torch.tensor(test_img_distance_coordinate_incre)
-
-        # 如果SimpleCIL分类拥有较高置信度
-        value_, index_ = torch.topk(test_img_distance_coordinate_incre, k=top_num, dim=0, largest=True, sorted=True)
-        test_img_coordinate_incre = index_.numpy().tolist()
-
-        predict = test_img_coordinate_incre
-
-        return predict, value_[0].numpy()
\ No newline at end of file
@@ -3,22 +3,36 @@ import numpy as np
 import torch
 from torch import nn
 from torch.serialization import load
-from tqdm import tqdm
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
-import timm
+from utils import weight_registry
 
 from .base import BaseLeaner
+import utils.toolkits as toolkits
+from utils.incremental_eval import TestFeatureStore, iter_test_outputs
+from utils.ncm import NCMClassifier
+from utils.anchors import anchor_coordinates, load_anchor_bank
+from utils.prototypes import PrototypeAccumulator, PrototypeBank
 
 
 class Learner(BaseLeaner):
     def __init__(self, args):
         super().__init__(args)
         self.args = args
-        self._network = timm.create_model("vit_base_patch16_224", pretrained=True, num_classes=0)
+        self._network = weight_registry.create_model("vit_base_patch16_224", root=args.get("weight_dir"))
         self._network.eval()
-        self.outputs_list_mean_ImageNet_val200 = torch.load('../PTM_with_coordinate_proto/utils/outputs_list_mean_ImageNet_val200.pth')
+        self._network.requires_grad_(False)
+        # 可选: 增量评估, 旧类别测试样本的embedding保留, 每个任务只对新类别的测试样本前向
+        self.test_features = TestFeatureStore(self._device) if args.get("incremental_eval", False) else None
+        # anchor bank [A, D], 由 python -m utils.anchors 从本地图片目录构建(.npy, memmap读取), 也兼容旧的 .pth
+        if "anchor_bank" not in args:
+            raise ValueError("constantcoordinatecil requires \"anchor_bank\" in the config, "
+                             "build one with: python -m utils.anchors --images <image_root> --out <anchor_bank>.npy")
+        self.anchors = load_anchor_bank(args["anchor_bank"]).to(self._device)
+        self.anchor_power = args.get("anchor_power", -2)    # 这里的指数可以更改
+        self.proto_bank = PrototypeBank(device=self._device)
+        # 坐标空间中按平方距离倒数取top-5, top-1 > 1.0 * top-2 时才输出预测
+        self.classifier = NCMClassifier(metric='inverse', top_num=5, confidence=1.0)
 
     def incremental_train(self, data_manager):
         self._cur_task = self._cur_task + 1
@@ -27,16 +41,16 @@ class Learner(BaseLeaner):
         # 数据包构建
         batch_size = 124
         train_indices = np.arange(self._known_classes, self._total_classes)
-        test_indices = np.arange(0, self._total_classes)
+        test_indices = np.arange(self._known_classes if self.test_features is not None else 0, self._total_classes)
 
         train_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="train", )
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader = toolkits.build_dataloader(train_dataset, self.args, batch_size=batch_size, shuffle=True)
 
         test_dataset = data_manager.get_dataset(indices=test_indices, source="test", mode="test")
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+        self.test_loader = toolkits.build_dataloader(test_dataset, self.args, batch_size=batch_size, shuffle=False)
 
         train_dataset_for_protonet = data_manager.get_dataset(indices=train_indices, source="train", mode="test", )
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader_for_protonet = toolkits.build_dataloader(train_dataset_for_protonet, self.args, batch_size=batch_size, shuffle=True)
 
         # 训练
         # self._train(self.train_loader, self.test_loader, self.train_loader_for_protonet)
@@ -45,92 +59,27 @@ class Learner(BaseLeaner):
     def _train(self,):
         self._network.to(self._device)
 
-        # 推理
-        embedding_list = []
-        label_list = []
-        with torch.no_grad():
-            for i, batch in enumerate(tqdm(self.train_loader_for_protonet)):
-                (_, data, label) = batch
-                data = data.to(self._device)
-                # label = label.to(self._device)
-
-                # 获取proto的核心, model.convnet(), 来自BaseNet类
-                embedding = self._network(data)
-                embedding_list.append(embedding.cpu())
-                label_list.append(label.cpu())
-        embedding_list = torch.cat(embedding_list, dim=0)
-        label_list = torch.cat(label_list, dim=0)
-
-        # NCM, 对class’s features取mean
-        class_list = np.unique(label_list)
-        constantcoordinate_proto_list = []
-        for class_index in class_list:
-            # print('Replacing...',class_index)
-            data_index = (label_list == class_index).nonzero().squeeze(-1)
-            embeddings = embedding_list[data_index]
-
-            # 这里开始与simplecil不同
-            embeddings_coordinate_200 = []
-            for output_that in embeddings:
+        # 推理, 开启embedding_cache时冻结backbone的特征直接从缓存读取
+        embedding_list, label_list = toolkits.extract_embeddings(
+            self.train_loader_for_protonet, self._device, self._network,
+            cache=self.embedding_cache, backbone_id="vit_base_patch16_224")
 
-                embedding_coordinate_200 = []
-                for outputs_list_mean_ImageNet_val200 in self.outputs_list_mean_ImageNet_val200:
-                    distance = torch.sum((output_that - outputs_list_mean_ImageNet_val200) ** 2)
-                    embedding_coordinate_200.append(distance ** -2)     # 这里的指数可以更改
-                embedding_coordinate_200 = torch.tensor(embedding_coordinate_200)
-                embeddings_coordinate_200.append(embedding_coordinate_200)
-
-            embeddings_coordinate_200 = torch.stack(embeddings_coordinate_200)
-            proto = embeddings_coordinate_200.mean(0)
-            constantcoordinate_proto_list.append(proto)
+        # 这里开始与simplecil不同: 先把embedding变换为到各anchor的坐标, 再对class’s coordinates取mean
+        coordinates = torch.cat([anchor_coordinates(chunk.to(self._device), self.anchors, self.anchor_power)
+                                 for chunk in embedding_list.split(4096)])
+        protos = PrototypeAccumulator(device=self._device).update(coordinates, label_list).protos()
 
         # 传递proto_list
-        if self._known_classes == 0:
-            self.constantcoordinate_proto_list = constantcoordinate_proto_list
-        else:
-            self.constantcoordinate_proto_list = self.constantcoordinate_proto_list + constantcoordinate_proto_list
+        self.proto_bank.add_task(protos)
 
     def eval_task(self):
         y_pred, y_true = [], []
-        for _, (_, inputs, targets) in enumerate(tqdm(self.test_loader)):
-            inputs = inputs.to(self._device)
-            with torch.no_grad():
-                outputs = self._network(inputs)
-
-                for _, test_output in enumerate(outputs):
-                    predict = self.classify_with_proto(test_output)
-                    y_pred.append(predict)
-                    y_true.append(targets[_].item())
-
-        return y_pred, y_true
-
-    def classify_with_proto(self, test_output):
-        top_num = 5
-        test_output = test_output.cpu()
-        predict = [-1 for _ in range(top_num)]
-
-        test_embed_coordinate = []
-        for outputs_list_mean_ImageNet_val200 in self.outputs_list_mean_ImageNet_val200:
-            distance = torch.sum((test_output - outputs_list_mean_ImageNet_val200) ** 2)
-            test_embed_coordinate.append(distance ** -2)    # 这里的指数可以更改
-        test_embed_coordinate = torch.tensor(test_embed_coordinate)
-
-        distance_with_protos = []
-        for proto in self.constantcoordinate_proto_list:
-            distance = torch.sum((test_embed_coordinate - proto) ** 2)
-            distance_with_protos.append(1/distance)
-        distance_with_protos = torch.tensor(distance_with_protos)
-
-
-        value_, index_ = torch.topk(distance_with_protos, k=top_num, dim=0, largest=True, sorted=True)
-        test_img_coordinate_incre = index_.numpy().tolist()
-        top0_index = test_img_coordinate_incre[0]
-        top1_index = test_img_coordinate_incre[1]
-        top2_index = test_img_coordinate_incre[2]
-
-        # 条件判断是否仅使用SimpleCIL分类
-        if distance_with_protos[top0_index] > 1.0 * distance_with_protos[top1_index]:
-            predict = test_img_coordinate_incre
+        with torch.no_grad():
+            for outputs, targets in iter_test_outputs(self.test_loader, self._device, self._network, store=self.test_features,
+                                                      task_id=self._cur_task, cache=self.embedding_cache, backbone_id="vit_base_patch16_224"):
+                coordinates = anchor_coordinates(outputs, self.anchors, self.anchor_power)
+                y_pred.extend(self.classifier.predict(coordinates, self.proto_bank.prototypes).tolist())
+                y_true.extend(targets.tolist())
 
         # predict为一list包含前top_num个预测结果
-        return predict
+        return y_pred, y_true
@@ -3,13 +3,16 @@ import numpy as np
 import torch
 from torch import nn
 from torch.serialization import load
-from tqdm import tqdm
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
-import timm
+from utils import weight_registry
 
 from .base import BaseLeaner
+import utils.toolkits as toolkits
+from utils.incremental_eval import TestFeatureStore, iter_test_outputs
+from utils.ncm import NCMClassifier
+from utils.prototypes import ExemplarBank
+from utils.pq import PQExemplarBank
 
 
 # without exemplar版本
@@ -17,8 +20,18 @@ class Learner(BaseLeaner):
     def __init__(self, args):
         super().__init__(args)
         self.args = args
-        self._network = timm.create_model("vit_base_patch16_224", pretrained=True, num_classes=0)
+        self._network = weight_registry.create_model("vit_base_patch16_224", root=args.get("weight_dir"))
         self._network.eval()
+        self._network.requires_grad_(False)
+        # 可选: 增量评估, 旧类别测试样本的embedding保留, 每个任务只对新类别的测试样本前向
+        self.test_features = TestFeatureStore(self._device) if args.get("incremental_eval", False) else None
+        # 每个类别取最近的训练样本embedding, 按平方距离倒数取top-3
+        self.classifier = NCMClassifier(metric='inverse', top_num=3)
+        # 所有训练样本embedding按类别以CSR形式存放; 开启pq_exemplars时每个任务训练一套PQ codebooks, 只保存uint8 codes
+        if args.get("pq_exemplars", False):
+            self.proto_bank = PQExemplarBank(device=self._device, num_subspaces=args.get("pq_subspaces", 16))
+        else:
+            self.proto_bank = ExemplarBank(device=self._device)
 
     def incremental_train(self, data_manager):
         self._cur_task = self._cur_task + 1
@@ -27,16 +40,16 @@ class Learner(BaseLeaner):
         # 数据包构建
         batch_size = 124
         train_indices = np.arange(self._known_classes, self._total_classes)
-        test_indices = np.arange(0, self._total_classes)
+        test_indices = np.arange(self._known_classes if self.test_features is not None else 0, self._total_classes)
 
         train_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="train", )
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader = toolkits.build_dataloader(train_dataset, self.args, batch_size=batch_size, shuffle=True)
 
         test_dataset = data_manager.get_dataset(indices=test_indices, source="test", mode="test")
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+        self.test_loader = toolkits.build_dataloader(test_dataset, self.args, batch_size=batch_size, shuffle=False)
 
         train_dataset_for_protonet = data_manager.get_dataset(indices=train_indices, source="train", mode="test", )
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader_for_protonet = toolkits.build_dataloader(train_dataset_for_protonet, self.args, batch_size=batch_size, shuffle=True)
 
         # 训练
         # self._train(self.train_loader, self.test_loader, self.train_loader_for_protonet)
@@ -45,76 +58,23 @@ class Learner(BaseLeaner):
     def _train(self,):
         self._network.to(self._device)
 
-        # 推理
-        embedding_list = []
-        label_list = []
-        with torch.no_grad():
-            for i, batch in enumerate(tqdm(self.train_loader_for_protonet)):
-                (_, data, label) = batch
-                data = data.to(self._device)
-                # label = label.to(self._device)
-
-                # 获取proto的核心, model.convnet(), 来自BaseNet类
-                embedding = self._network(data)
-                embedding_list.append(embedding.cpu())
-                label_list.append(label.cpu())
-        embedding_list = torch.cat(embedding_list, dim=0)
-        label_list = torch.cat(label_list, dim=0)
+        # 推理, 开启embedding_cache时冻结backbone的特征直接从缓存读取
+        embedding_list, label_list = toolkits.extract_embeddings(
+            self.train_loader_for_protonet, self._device, self._network,
+            cache=self.embedding_cache, backbone_id="vit_base_patch16_224")
 
-        # NCM, 对class’s features取mean
-        class_list = np.unique(label_list)
-        feature_proto_list = []
-        for class_index in class_list:
-            # print('Replacing...',class_index)
-            data_index = (label_list == class_index).nonzero().squeeze(-1)
-            embeddings = embedding_list[data_index]
-            # proto = embeddings.mean(0)    # simplecil
-            protos = embeddings
-            feature_proto_list.append(protos)
-
-        # 传递proto_list
-        if self._known_classes == 0:
-            self.feature_proto_list = feature_proto_list
-            # print('self.feature_proto_list[0].shape:', self.feature_proto_list[0])
-        else:
-            self.feature_proto_list = self.feature_proto_list + feature_proto_list
+        # 不取mean, 每个训练样本的embedding都作为所属类别的prototype
+        self.proto_bank.add_task(embedding_list, label_list)
+        if isinstance(self.proto_bank, PQExemplarBank):
+            print('pq exemplars: {:.2f}MB vs float32 {:.2f}MB'.format(
+                self.proto_bank.memory_bytes() / 2 ** 20, self.proto_bank.float32_bytes() / 2 ** 20))
 
     def eval_task(self):
         y_pred, y_true = [], []
-        for _, (_, inputs, targets) in enumerate(tqdm(self.test_loader)):
-            inputs = inputs.to(self._device)
-            with torch.no_grad():
-                outputs = self._network(inputs)
-
-                for _, test_output in enumerate(outputs):
-                    predict = self.classify_with_proto(test_output)
-                    y_pred.append(predict)
-                    y_true.append(targets[_].item())
+        with torch.no_grad():
+            for outputs, targets in iter_test_outputs(self.test_loader, self._device, self._network, store=self.test_features,
+                                                      task_id=self._cur_task, cache=self.embedding_cache, backbone_id="vit_base_patch16_224"):
+                y_pred.extend(self.classifier.predict(outputs, self.proto_bank).tolist())
+                y_true.extend(targets.tolist())
 
         return y_pred, y_true
-
-    def classify_with_proto(self, test_output):
-        top_num = 3
-        test_output = test_output.cpu()
-        predict = [-1 for _ in range(top_num)]
-
-        # CrazyCIL分类
-        # 找到每个特征集中的最小距离
-        min_distances = []
-        for protos in self.feature_proto_list:
-            # 计算 test_output 与当前特征原型集的距离
-            distances = torch.sum((test_output - protos) ** 2, dim=1)
-
-            # 找到最小距离
-            min_distance = torch.min(distances)
-            min_distances.append(min_distance)
-
-        # 计算倒数并存储结果
-        test_img_distance_coordinate_incre = [1 / d for d in min_distances]
-        test_img_distance_coordinate_incre = torch.tensor(test_img_distance_coordinate_incre)
-
-        # 如果SimpleCIL分类拥有较高置信度
-        value_, index_ = torch.topk(test_img_distance_coordinate_incre, k=top_num, dim=0, largest=True, sorted=True)
-        predict = index_.numpy().tolist()
-
-        return predict
@@ -3,13 +3,15 @@ import numpy as np
 import torch
 from torch import nn
 from torch.serialization import load
-from tqdm import tqdm
 from torch import optim
-from torch.nn import functional as F
-from torch.utils.data import DataLoader
-import timm
+from utils import weight_registry
 from collections import OrderedDict
 from transformers import ViTForImageClassification
+import utils.toolkits as toolkits
+from utils.incremental_eval import TestFeatureStore, iter_test_outputs
+from utils.embedding_cache import EmbeddingCache
+from utils.ncm import NCMClassifier
+from utils.ann import IVFIndex
 
 
 class Learner:
@@ -18,11 +20,20 @@ class Learner:
         self._cur_task = -1
         self._known_classes = 0
         self._total_classes = 0
-        self._network = timm.create_model(args["pretrained_model"], pretrained=True, num_classes=0)
+        self._network = weight_registry.create_model(args["pretrained_model"], root=args.get("weight_dir"))
         self._network.eval()
+        self._network.requires_grad_(False)
         self._old_network = None
         self._data_memory, self._targets_memory = np.array([]), np.array([])
         self._device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.embedding_cache = EmbeddingCache(args.get("cache_dir", "./cache")) if args.get("embedding_cache", False) else None
+        # 可选: 增量评估, 旧类别测试样本的embedding保留, 每个任务只对新类别的测试样本前向
+        self.test_features = TestFeatureStore(self._device) if args.get("incremental_eval", False) else None
+
+        # SimpleCIL分类: 余弦相似度 top-2, top-1 > 1.0 * top-2 时才输出预测
+        self.ann_index = IVFIndex(nprobe=args.get("ann_nprobe", 8), metric='cosine', device=self._device) \
+            if args.get("ann_index", False) else None
+        self.classifier = NCMClassifier(metric='cosine', top_num=2, confidence=1.0, index=self.ann_index)
 
     def after_task(self):
         self._known_classes = self._total_classes
@@ -34,16 +45,16 @@ class Learner:
         # 数据包构建
         batch_size = 124
         train_indices = np.arange(self._known_classes, self._total_classes)
-        test_indices = np.arange(0, self._total_classes)
+        test_indices = np.arange(self._known_classes if self.test_features is not None else 0, self._total_classes)
 
         train_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="train", )
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader = toolkits.build_dataloader(train_dataset, self.args, batch_size=batch_size, shuffle=True)
 
         test_dataset = data_manager.get_dataset(indices=test_indices, source="test", mode="test")
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+        self.test_loader = toolkits.build_dataloader(test_dataset, self.args, batch_size=batch_size, shuffle=False)
 
         train_dataset_for_protonet = data_manager.get_dataset(indices=train_indices, source="train", mode="test", )
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader_for_protonet = toolkits.build_dataloader(train_dataset_for_protonet, self.args, batch_size=batch_size, shuffle=True)
 
         # 训练
         # self._train(self.train_loader, self.test_loader, self.train_loader_for_protonet)
@@ -52,31 +63,11 @@ class Learner:
     def _train(self,):
         self._network.to(self._device)
 
-        # 推理
-        embedding_list = []
-        label_list = []
-        with torch.no_grad():
-            for i, batch in enumerate(tqdm(self.train_loader_for_protonet, ncols=120)):
-                (_, data, label) = batch
-                data = data.to(self._device)
-                # label = label.to(self._device)
-
-                # 获取proto的核心, model.convnet(), 来自BaseNet类
-                embedding = self._network(data)
-                embedding_list.append(embedding.cpu())
-                label_list.append(label.cpu())
-        embedding_list = torch.cat(embedding_list, dim=0)
-        label_list = torch.cat(label_list, dim=0)
-
-        # NCM, 对class’s features取mean
-        class_list = np.unique(label_list)
-        feature_proto_list = []
-        for class_index in class_list:
-            # print('Replacing...',class_index)
-            data_index = (label_list == class_index).nonzero().squeeze(-1)
-            embeddings = embedding_list[data_index]
-            proto = embeddings.mean(0)
-            feature_proto_list.append(proto)
+        # 推理, 开启embedding_cache时冻结backbone的特征直接从缓存读取
+        # NCM, 对class’s features取mean, 按类别流式累加
+        feature_proto_list = toolkits.get_protos_with_tqdm(
+            self.train_loader_for_protonet, self._device, self._network,
+            cache=self.embedding_cache, backbone_id=self.args["pretrained_model"])
 
         # 传递proto_list
         if self._known_classes == 0:
@@ -86,45 +77,13 @@ class Learner:
 
     def eval_task(self):
         y_pred, y_true = [], []
-        for _, (_, inputs, targets) in enumerate(tqdm(self.test_loader, ncols=120)):
-            inputs = inputs.to(self._device)
-            with torch.no_grad():
-                outputs = self._network(inputs)
-
-                for _, test_output in enumerate(outputs):
-                    predict = self.classify_with_proto(test_output)
-                    y_pred.append(predict)
-                    y_true.append(targets[_].item())
+        prototypes = torch.stack(self.feature_proto_list).to(self._device)
+        if self.ann_index is not None:
+            self.ann_index.sync(prototypes)
+        with torch.no_grad():
+            for outputs, targets in iter_test_outputs(self.test_loader, self._device, self._network, store=self.test_features,
+                                                      task_id=self._cur_task, cache=self.embedding_cache, backbone_id=self.args["pretrained_model"]):
+                y_pred.extend(self.classifier.predict(outputs, prototypes).tolist())
+                y_true.extend(targets.tolist())
 
         return y_pred, y_true
-
-    def classify_with_proto(self, test_output):
-        top_num = 2
-        test_output = test_output.cpu()
-        predict = [-1 for _ in range(top_num)]
-
-        # SimpleCIL分类
-        test_img_distance_coordinate_incre = []
-        for i in range(len(self.feature_proto_list)):
-            # L2距离
-            # distance = torch.sum((test_output - self.feature_proto_list[i]) ** 2)
-            # test_img_distance_coordinate_incre.append(1 / distance)
-
-            # 余弦相似度
-            cosine_similarity = F.cosine_similarity(test_output.unsqueeze(0), self.feature_proto_list[i].unsqueeze(0), dim=1)
-            test_img_distance_coordinate_incre.append(cosine_similarity[0])
-        test_img_distance_coordinate_incre = torch.tensor(test_img_distance_coordinate_incre)
-        # print('test_img_distance_coordinate_incre', test_img_distance_coordinate_incre)
-
-        # 如果SimpleCIL分类拥有较高置信度
-        value_, index_ = torch.topk(test_img_distance_coordinate_incre, k=top_num, dim=0, largest=True, sorted=True)
-        test_img_coordinate_incre = index_.numpy().tolist()
-        top0_index = test_img_coordinate_incre[0]
-        top1_index = test_img_coordinate_incre[1]
-        # top2_index = test_img_coordinate_incre[2]
-
-        # 条件判断是否仅使用SimpleCIL分类
-        if test_img_distance_coordinate_incre[top0_index] > 1.0 * test_img_distance_coordinate_incre[top1_index]:
-            predict = test_img_coordinate_incre
-
-        return predict
@@ -6,6 +6,7 @@ from torch import nn
 from torch.utils.data import DataLoader
 
 import utils.toolkits as toolkits
+from utils.embedding_cache import EmbeddingCache
 
 
 class BaseLeaner(object):
@@ -23,6 +24,9 @@ class BaseLeaner(object):
         # self._fixed_memory = args.get("fixed_memory", False)
         self._device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
+        # 可选: 按 (backbone, prompt/adapter, transform模式, sample_id) 缓存确定性模式下的embedding
+        self.embedding_cache = EmbeddingCache(args.get("cache_dir", "./cache")) if args.get("embedding_cache", False) else None
+
     def after_task(self):
         self._known_classes = self._total_classes
 
@@ -5,7 +5,6 @@ from torch import nn
 from tqdm import tqdm
 from torch import optim
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 import timm
 from collections import OrderedDict
 from transformers import ViTForImageClassification
@@ -17,6 +16,7 @@ from transformers import ViTForImageClassification
 
 from .base import BaseLeaner
 from convs.vpt import build_promptmodel
+import utils.toolkits as toolkits
 
 class Learner(BaseLeaner):
     def __init__(self, args):
@@ -38,13 +38,13 @@ class Learner(BaseLeaner):
         test_indices = np.arange(0, self._total_classes)
 
         train_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="train", )
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader = toolkits.build_dataloader(train_dataset, self.args, batch_size=batch_size, shuffle=True)
 
         test_dataset = data_manager.get_dataset(indices=test_indices, source="test", mode="test")
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+        self.test_loader = toolkits.build_dataloader(test_dataset, self.args, batch_size=batch_size, shuffle=False)
 
         train_dataset_for_protonet = data_manager.get_dataset(indices=train_indices, source="train", mode="test", )
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader_for_protonet = toolkits.build_dataloader(train_dataset_for_protonet, self.args, batch_size=batch_size, shuffle=True)
 
         # 只研究前三个数据包
         if self._known_classes == 0:
@@ -12,6 +12,12 @@ from convs.losses import NCMLoss
 import timm
 from convs.mine11 import Mine11
 import utils.toolkits as toolkits
+from utils.prototypes import PrototypeBank
+from utils.ann import IVFIndex
+from utils.ncm import ncm_topk
+from utils.metrics import AccuracyMeter
+from utils.teacher_cache import TeacherCache
+from utils.embedding_cache import EmbeddingCache
 
 
 class Learner:
@@ -24,11 +30,16 @@ class Learner:
         self._known_classes = 0
         self._total_classes = 0
         self.classes_per_task = []
-        self.feature_proto_list = None
         self.adapter_pool = []
         self._data_memory, self._targets_memory = np.array([]), np.array([])
         self._device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.prototype_bank = PrototypeBank(device=self._device)
+        # 可选: 类别数很大时最终测试用IVF近似最近邻索引, 每次测试前与prototype_bank同步(不重新聚类)
+        self.ann_index = IVFIndex(nprobe=args.get("ann_nprobe", 8), device=self._device) \
+            if args.get("ann_index", False) else None
         self._old_network = self.call_model()
+        # 可选: prompt/adapter不变时(如跳过训练的任务、最终测试)复用已缓存的embedding; 逐epoch训练中的推理不缓存
+        self.embedding_cache = EmbeddingCache(args.get("cache_dir", "./cache")) if args.get("embedding_cache", False) else None
 
     def after_task(self):
         self._known_classes = self._total_classes
@@ -49,19 +60,19 @@ class Learner:
         test_indices = np.arange(0, self._total_classes)
 
         train_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="train", )
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader = toolkits.build_dataloader(train_dataset, self.args, batch_size=batch_size, shuffle=True)
 
         sa_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="strong", )
         # sa_dataset1 = data_manager.get_dataset(indices=train_indices, source="train", mode="strong", )
         # sa_dataset2 = data_manager.get_dataset(indices=train_indices, source="train", mode="strong", )
         # combined_dataset = ConcatDataset([sa_dataset, sa_dataset1, sa_dataset2])
-        self.sa_loader = DataLoader(sa_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.sa_loader = toolkits.build_dataloader(sa_dataset, self.args, batch_size=batch_size, shuffle=True)
 
         test_dataset = data_manager.get_dataset(indices=test_indices, source="test", mode="test")
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+        self.test_loader = toolkits.build_dataloader(test_dataset, self.args, batch_size=batch_size, shuffle=False)
 
         train_dataset_for_protonet = data_manager.get_dataset(indices=train_indices, source="train", mode="test", )
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader_for_protonet = toolkits.build_dataloader(train_dataset_for_protonet, self.args, batch_size=batch_size, shuffle=True)
 
         self._train()
 
@@ -75,18 +86,17 @@ class Learner:
         # 推理
         # bias = 10 * torch.randn(768)
         # feature_proto_list = [torch.randn(768) + bias for _ in self.cur_classes]
-        feature_proto_list = toolkits.get_protos_with_tqdm(self.train_loader_for_protonet, self._device, self._network)
-        self.previous_feature_proto_list = [] if self._known_classes == 0 else self.feature_proto_list
-        self.feature_proto_list = feature_proto_list if self._known_classes == 0 else self.feature_proto_list + feature_proto_list
-        self.prototypes = torch.stack(self.feature_proto_list).to(self._device)
+        feature_proto_list, train_accuracy = toolkits.get_protos_and_accuracy(
+            self.train_loader_for_protonet, self._device, self._network, previous_protos=self.prototype_bank.prototypes,
+            words='SHOW Train', cache=self.embedding_cache, backbone_id="vit_base_patch16_224_in21k")
+        self.prototype_bank.add_task(feature_proto_list)
+        self.prototypes = self.prototype_bank.prototypes
 
         # 测试
-        toolkits.test_accuracy(model=self._network, data_loader=self.train_loader_for_protonet,
-                               prototypes=self.prototypes, epoch=-1,
-                               num_epochs=0, device=self._device, words='SHOW Train')
         toolkits.test_accuracy(model=self._network, data_loader=self.test_loader,
                                prototypes=self.prototypes, epoch=-1,
-                               num_epochs=0, device=self._device, words='SHOW Test')
+                               num_epochs=0, device=self._device, words='SHOW Test',
+                               cache=self.embedding_cache, backbone_id="vit_base_patch16_224_in21k")
 
         if self._cur_task < 10:
             self.train_vpt()
@@ -108,6 +118,11 @@ class Learner:
         optimizer = optim.SGD(self._network.parameters(), momentum=0, lr=lr_, weight_decay=5e-4)
         loss_fn = NCMLoss()
 
+        # 旧adapter在本任务内不变, 其在train_loader_for_protonet(确定性transforms)上的输出只前向一次, 训练时按batch下标读取
+        teacher_cache = TeacherCache(device=self._device).build(
+            self.train_loader_for_protonet, self._old_network, self.adapter_pool,
+            load_teacher=lambda network, adapter: setattr(network.backbone, 'cur_adapter', adapter))
+
         # 训练VPT
         train_accuracy_max = 0.0
         self.adapter_ = None
@@ -117,7 +132,7 @@ class Learner:
 
             # 创建 tqdm 进度条
             with (tqdm(total=len(self.train_loader), desc=f"Epoch [{epoch + 1}/{self.args["tuned_epoch"]}]", ncols=120) as pbar):
-                for batch_counter, (_, inputs, targets) in enumerate(self.train_loader_for_protonet):
+                for batch_counter, (idx, inputs, targets) in enumerate(self.train_loader_for_protonet):
                     inputs, targets = inputs.to(self._device), targets.to(self._device)
 
                     # 前向传播
@@ -142,6 +157,7 @@ class Learner:
                         adapter_pool=self.adapter_pool,
                         old_networks=self._old_network,
                         current_outputs=outputs,
+                        old_outputs=teacher_cache.get(idx),
                     )
 
                     # 反向传播
@@ -154,15 +170,13 @@ class Learner:
                     pbar.set_postfix(loss=loss_average)  # 显示损失和准确率
                     pbar.update(1)  # 更新进度条
 
-            # 推理得到新的prototypes
-            feature_proto_list = toolkits.get_protos_with_tqdm(self.train_loader_for_protonet, self._device, self._network)
-            self.feature_proto_list = self.previous_feature_proto_list + feature_proto_list
-            self.prototypes = torch.stack(self.feature_proto_list).to(self._device)
-
-            # 测试
-            train_accuracy = toolkits.test_accuracy(model=self._network, data_loader=self.train_loader_for_protonet,
-                                                    prototypes=self.prototypes, epoch=epoch,
-                                                    num_epochs=self.args["tuned_epoch"], device=self._device, words='Train')
+            # 推理得到新的prototypes, 同一次前向同时计算训练集准确率
+            feature_proto_list, train_accuracy = toolkits.get_protos_and_accuracy(
+                self.train_loader_for_protonet, self._device, self._network,
+                previous_protos=self.prototype_bank.previous(self._cur_task), epoch=epoch,
+                num_epochs=self.args["tuned_epoch"], words='Train')
+            self.prototype_bank.set_task(self._cur_task, feature_proto_list)
+            self.prototypes = self.prototype_bank.prototypes
 
             # 绘tsne图
             toolkits.tsne_classes(feature_bank, target_bank)
@@ -182,17 +196,17 @@ class Learner:
             self.adapter_ = toolkits.weighted_adapter_average(self.adapter_pool[-1], self.adapter_, alpha) # (1 - alpha) * val_old + alpha * val_adapter_
         self._network.backbone.cur_adapter = self.adapter_
         self._network.to(self._device)
-        feature_proto_list = toolkits.get_protos_with_tqdm(self.train_loader_for_protonet, self._device, self._network)
-        self.feature_proto_list = self.previous_feature_proto_list + feature_proto_list
-        self.prototypes = torch.stack(self.feature_proto_list).to(self._device)
-        toolkits.test_accuracy(model=self._network, data_loader=self.train_loader_for_protonet,
-                               prototypes=self.prototypes, device=self._device, words='Merge')
+        feature_proto_list, _ = toolkits.get_protos_and_accuracy(
+            self.train_loader_for_protonet, self._device, self._network,
+            previous_protos=self.prototype_bank.previous(self._cur_task), words='Merge',
+            cache=self.embedding_cache, backbone_id="vit_base_patch16_224_in21k")
+        self.prototype_bank.set_task(self._cur_task, feature_proto_list)
+        self.prototypes = self.prototype_bank.prototypes
 
         # Prototypes Drift Predict
         if 0 < self._cur_task < 10:
             self.get_prototypes_drift()
-            self.feature_proto_list = self.previous_feature_proto_list + feature_proto_list
-            self.prototypes = torch.stack(self.feature_proto_list).to(self._device)
+            self.prototypes = self.prototype_bank.prototypes
 
         # 保存prompt_token
         self.adapter_pool.append(self.adapter_)
@@ -206,29 +220,31 @@ class Learner:
         model.to(self._device)
         data_loader = self.test_loader
         num_classes = self.prototypes.size(0)  # 总类别数
+        if self.ann_index is not None:
+            self.ann_index.sync(self.prototypes)
+        # 保留逐样本的top-1预测, 由main.py汇总为跨任务准确率矩阵
+        meter = self.eval_meter = AccuracyMeter(num_classes=num_classes, top_ks=sorted({1, top_num}),
+                                                device=self._device, keep_predictions=True)
         with tqdm(total=len(data_loader), desc=f"Task{words}", ncols=120) as pbar_test:
-            y_pred, y_true = [], []
             with torch.no_grad():
                 for _, inputs, targets in data_loader:
                     inputs, targets = inputs.to(self._device), targets.to(self._device)
                     outputs = model(inputs)
 
-                    # 批量计算与所有原型的L2距离（高效向量化）
-                    temperature = 1.0
-                    distances = torch.cdist(outputs, self.prototypes, p=2)
-                    logits = -distances / temperature
-
-                    # 取Top-K预测结果
-                    _, top_indices = torch.topk(logits, k=top_num, dim=1)
-                    batch_preds = top_indices.cpu().tolist()  # 取Top1预测
-
-                    y_pred.extend(batch_preds)
-                    y_true.extend(targets.cpu().tolist())
+                    # 按类别分块计算L2距离并合并Top-K预测结果, 或用ANN索引近似检索
+                    if self.ann_index is not None:
+                        _, top_indices = self.ann_index.search(outputs, k=top_num)
+                    else:
+                        _, top_indices = ncm_topk(outputs, self.prototypes, k=top_num,
+                                                  proto_sq_norms=self.prototype_bank.sq_norms)
+                    meter.update(top_indices, targets, num_classes=num_classes)
 
-                    # 更新进度条
-                    test_accuracy = 100 * toolkits.top_k_accuracy(y_pred, y_true, k=1)
-                    pbar_test.set_postfix(accuracy=f"{test_accuracy:.2f}%")
+                    # 更新进度条, 每report_every个batch同步一次
+                    if meter.should_report():
+                        pbar_test.set_postfix(accuracy=f"{meter.accuracy():.2f}%")
                     pbar_test.update(1)
+            test_accuracy = meter.accuracy()
+            pbar_test.set_postfix(accuracy=f"{test_accuracy:.2f}%")
 
         # ------------------------------------------------------------------
         # TSNE
@@ -300,9 +316,9 @@ class Learner:
         print()
 
         # 预测漂移后的prototypes
-        old_prototypes = torch.stack(self.previous_feature_proto_list).to(self._device)
+        old_prototypes = self.prototype_bank.previous(self._cur_task)
         new_prototypes = DP_network(old_prototypes)
-        self.previous_feature_proto_list = list(new_prototypes.cpu().detach().unbind(0))
+        self.prototype_bank.replace(0, new_prototypes)
 
 
 # 设计以预测prototypes漂移
@@ -6,13 +6,18 @@ from tqdm import tqdm
 from torch import optim
 from torch.nn import functional as F
 import matplotlib.pyplot as plt
-from torch.utils.data import DataLoader, ConcatDataset
+from torch.utils.data import DataLoader
 
 from convs.losses import NCMLoss
 import timm
 from collections import OrderedDict
 from convs.vpt import build_promptmodel
 import utils.toolkits as toolkits
+from utils.prototypes import PrototypeBank
+from utils.ann import IVFIndex
+from utils.metrics import AccuracyMeter
+from utils.samplers import RepeatSampler, InfiniteLoader
+from utils.embedding_cache import EmbeddingCache
 
 
 class Learner:
@@ -24,11 +29,19 @@ class Learner:
         self._known_classes = 0
         self._total_classes = 0
         self.classes_per_task = []
-        self.feature_proto_list = None
         self.prompt_pool = []
         self._data_memory, self._targets_memory = np.array([]), np.array([])
         self._device = 'cuda' if torch.cuda.is_available() else 'cpu'
-        self._old_network = self.call_model()
+        self.prototype_bank = PrototypeBank(device=self._device)
+        # 可选: 类别数很大时最终测试用IVF近似最近邻索引, 每次测试前与prototype_bank同步(不重新聚类)
+        self.ann_index = IVFIndex(nprobe=args.get("ann_nprobe", 8), device=self._device) \
+            if args.get("ann_index", False) else None
+        # 新旧网络共享一份冻结的ViT权重, 旧网络为旧prompt下的视图(初始为全零prompt), 不再每个任务重建模型
+        self._network = self.call_model()
+        self._old_network = self._network.prompt_view(0)
+        self._old_network.load_prompt(self._network.obtain_prompt())
+        # 可选: prompt/adapter不变时(如跳过训练的任务、最终测试)复用已缓存的embedding; 逐epoch训练中的推理不缓存
+        self.embedding_cache = EmbeddingCache(args.get("cache_dir", "./cache")) if args.get("embedding_cache", False) else None
 
     def after_task(self):
         self._known_classes = self._total_classes
@@ -37,7 +50,7 @@ class Learner:
         return build_promptmodel(modelname="vit_base_patch16_224_in21k",
                                  Prompt_Token_num=self.args["Prompt_Token_num"],
                                  VPT_type=self.args["VPT_type"], args=self.args,
-                                 new_classes=0, frozen_heads=True).to(self._device)
+                                 new_classes=0, frozen_heads=True, multi_prompt=True).to(self._device)
 
     def incremental_train(self, data_manager):
         self._cur_task = self._cur_task + 1
@@ -52,24 +65,23 @@ class Learner:
         test_indices = np.arange(0, self._total_classes)
 
         train_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="train", )
-        self.train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader = toolkits.build_dataloader(train_dataset, self.args, batch_size=batch_size, shuffle=True)
 
+        # 强增强的辅助数据: 单个数据集按sa_repeats(默认3)虚拟重复, 无限采样, 整个任务只创建一次迭代器
         sa_dataset = data_manager.get_dataset(indices=train_indices, source="train", mode="strong", )
-        sa_dataset1 = data_manager.get_dataset(indices=train_indices, source="train", mode="strong", )
-        sa_dataset2 = data_manager.get_dataset(indices=train_indices, source="train", mode="strong", )
-        combined_dataset = ConcatDataset([sa_dataset, sa_dataset1, sa_dataset2])
-        self.sa_loader = DataLoader(combined_dataset, batch_size=batch_size, shuffle=True, num_workers=0)
+        sa_sampler = RepeatSampler(len(sa_dataset), repeats=self.args.get("sa_repeats", 3), infinite=True)
+        self.sa_loader = toolkits.build_dataloader(sa_dataset, self.args, batch_size=batch_size, sampler=sa_sampler)
+        self.sa_stream = InfiniteLoader(self.sa_loader)
 
         test_dataset = data_manager.get_dataset(indices=test_indices, source="test", mode="test")
-        self.test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+        self.test_loader = toolkits.build_dataloader(test_dataset, self.args, batch_size=batch_size, shuffle=False)
 
         train_dataset_for_protonet = data_manager.get_dataset(indices=train_indices, source="train", mode="test", )
-        self.train_loader_for_protonet = DataLoader(train_dataset_for_protonet, batch_size=batch_size, shuffle=True, num_workers=0)
+        self.train_loader_for_protonet = toolkits.build_dataloader(train_dataset_for_protonet, self.args, batch_size=batch_size, shuffle=True)
 
         self._train()
 
     def _train(self,):
-        self._network = self.call_model()
         if self.prompt_pool != []:
             self._network.load_prompt(self.prompt_pool[0])
             self._network.to(self._device)
@@ -80,18 +92,17 @@ class Learner:
         # 推理
         # bias = 10 * torch.randn(768)
         # feature_proto_list = [torch.randn(768) + bias for num in self.cur_classes]
-        feature_proto_list = toolkits.get_protos_with_tqdm(self.train_loader_for_protonet, self._device, self._old_network)
-        self.previous_feature_proto_list = [] if self._known_classes == 0 else self.feature_proto_list
-        self.feature_proto_list = feature_proto_list if self._known_classes == 0 else self.feature_proto_list + feature_proto_list
-        self.prototypes = torch.stack(self.feature_proto_list).to(self._device)
+        feature_proto_list, train_accuracy = toolkits.get_protos_and_accuracy(
+            self.train_loader_for_protonet, self._device, self._old_network, previous_protos=self.prototype_bank.prototypes,
+            words='SHOW Train', cache=self.embedding_cache, backbone_id="vit_base_patch16_224_in21k")
+        self.prototype_bank.add_task(feature_proto_list)
+        self.prototypes = self.prototype_bank.prototypes
 
         # 测试
-        train_accuracy = toolkits.test_accuracy(model=self._old_network, data_loader=self.train_loader_for_protonet,
-                               prototypes=self.prototypes, epoch=-1,
-                               num_epochs=0, device=self._device, words='SHOW Train')
         toolkits.test_accuracy(model=self._old_network, data_loader=self.test_loader,
                                prototypes=self.prototypes, epoch=-1,
-                               num_epochs=0, device=self._device, words='SHOW Test')
+                               num_epochs=0, device=self._device, words='SHOW Test',
+                               cache=self.embedding_cache, backbone_id="vit_base_patch16_224_in21k")
 
         if self._cur_task < 100 and train_accuracy < 97.5:
             if self._cur_task < len(self.args["merge_epoch"]):
@@ -159,27 +170,23 @@ class Learner:
                     # )
 
                     # ==================== 最弱loss ====================
-                    loss = loss_fn.forward(features=outputs, labels=targets, prototypes=self.prototypes)
+                    loss = loss_fn.forward(features=outputs, labels=targets, prototypes=self.prototypes,
+                                           proto_sq_norms=self.prototype_bank.sq_norms)
 
                     # ==================== 通用性loss ====================
                     grad_accum_steps = 1  # 对应4个batch的梯度累加
                     if self.prompt_pool != []:
                         total_loss_g = 0.0
                         # 通过迭代器遍历4个batch（显存占用仅等效单个batch）
-                        sa_loader_iter = iter(self.sa_loader)
                         for accum_step in range(grad_accum_steps):
-                            try:
-                                _, inputs, targets = next(sa_loader_iter)
-                            except StopIteration:
-                                sa_loader_iter = iter(self.sa_loader)  # 循环加载数据
-                                _, inputs, targets = next(sa_loader_iter)
+                            _, inputs, targets = next(self.sa_stream)
 
                             inputs = inputs.to(self._device, non_blocking=True)
 
                             # 混合精度计算（显存节省30%-50%）
                             with torch.amp.autocast('cuda'):
-                                old_outputs = self._old_network(inputs)
-                                new_outputs = self._network(inputs)
+                                # 旧/新prompt在同一次前向中计算
+                                old_outputs, new_outputs = self._network.forward_prompts(inputs, [0, None])
                                 loss_g = loss_fn_mse(old_outputs, new_outputs) / grad_accum_steps  # 梯度标准化
 
                             # 梯度累加
@@ -201,16 +208,13 @@ class Learner:
                     pbar.set_postfix(loss=loss_average)  # 显示损失和准确率
                     pbar.update(1)  # 更新进度条
 
-            # 推理得到新的prototypes
-            feature_proto_list = toolkits.get_protos_with_tqdm(self.train_loader_for_protonet, self._device, self._network)
-            self.feature_proto_list = self.previous_feature_proto_list + feature_proto_list
-            self.prototypes = torch.stack(self.feature_proto_list).to(self._device)
-
-            # 测试
-            train_accuracy = toolkits.test_accuracy(model=self._network, data_loader=self.train_loader_for_protonet,
-                                                    prototypes=self.prototypes, epoch=epoch,
-                                                    num_epochs=self.args["tuned_epoch"], device=self._device,
-                                                    words='Train')
+            # 推理得到新的prototypes, 同一次前向同时计算训练集准确率
+            feature_proto_list, train_accuracy = toolkits.get_protos_and_accuracy(
+                self.train_loader_for_protonet, self._device, self._network,
+                previous_protos=self.prototype_bank.previous(self._cur_task), epoch=epoch,
+                num_epochs=self.args["tuned_epoch"], words='Train')
+            self.prototype_bank.set_task(self._cur_task, feature_proto_list)
+            self.prototypes = self.prototype_bank.prototypes
 
             # 绘tsne图
             # toolkits.tsne_classes(feature_bank, target_bank)
@@ -236,21 +240,22 @@ class Learner:
             self._network.load_prompt(prompt_)  # 再次推理得到新的prototypes
             self._network.to(self._device)
             feature_proto_list = toolkits.get_protos_with_tqdm(self.train_loader_for_protonet, self._device,
-                                                               self._network)
-            self.feature_proto_list = self.previous_feature_proto_list + feature_proto_list
-            self.prototypes = torch.stack(self.feature_proto_list).to(self._device)
+                                                               self._network, cache=self.embedding_cache,
+                                                               backbone_id="vit_base_patch16_224_in21k")
+            self.prototype_bank.set_task(self._cur_task, feature_proto_list)
+            self.prototypes = self.prototype_bank.prototypes
             # toolkits.test_accuracy(model=self._network, data_loader=self.train_loader_for_protonet,
             #                        prototypes=self.prototypes, device=self._device, words='Merge')
             test_acc = toolkits.test_accuracy(model=self._network, data_loader=self.test_loader,
-                                   prototypes=self.prototypes, device=self._device, words='Test')
+                                   prototypes=self.prototypes, device=self._device, words='Test',
+                                   cache=self.embedding_cache, backbone_id="vit_base_patch16_224_in21k")
 
         # Prototypes Drift Predict
         prototypes_drift = True
         if prototypes_drift:
             if 0 < self._cur_task < self.args["task_stop_p_drift"]:
                 self.get_prototypes_drift(prompt_ = prompt_)
-                self.feature_proto_list = self.previous_feature_proto_list + feature_proto_list
-                self.prototypes = torch.stack(self.feature_proto_list).to(self._device)
+                self.prototypes = self.prototype_bank.prototypes
 
         # 保存prompt_token
         self.prompt_pool.append(prompt_)
@@ -265,8 +270,15 @@ class Learner:
         model.load_prompt(self.prompt_pool[-1])
         model.to(self._device)
         data_loader = self.test_loader
+        if self.ann_index is not None:
+            self.ann_index.sync(self.prototypes)
+        # 保留逐样本的top-1预测, 由main.py汇总为跨任务准确率矩阵
+        self.eval_meter = AccuracyMeter(num_classes=len(self.prototypes), top_ks=sorted({1, top_num}),
+                                        device=self._device, keep_predictions=True)
         test_acc = toolkits.test_accuracy(model=model, data_loader=data_loader,
-                                prototypes=self.prototypes, device=self._device, words='Test')
+                                prototypes=self.prototypes, device=self._device, words='Test',
+                                cache=self.embedding_cache, backbone_id="vit_base_patch16_224_in21k",
+                                index=self.ann_index, meter=self.eval_meter)
 
         # ------------------------------------------------------------------
         # TSNE
@@ -340,9 +352,9 @@ class Learner:
         print()
 
         # 预测漂移后的prototypes
-        old_prototypes = torch.stack(self.previous_feature_proto_list).to(self._device)
+        old_prototypes = self.prototype_bank.previous(self._cur_task)
         new_prototypes = DP_network(old_prototypes)
-        self.previous_feature_proto_list = list(new_prototypes.cpu().detach().unbind(0))
+        self.prototype_bank.replace(0, new_prototypes)
 
 
 # 设计以预测prototypes漂移
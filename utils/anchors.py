@@ -0,0 +1,80 @@
+import os
+import argparse
+import numpy as np
+import torch
+from torchvision import datasets, transforms
+
+from .ncm import sq_l2_distances
+from .prototypes import PrototypeAccumulator
+
+
+def anchor_coordinates(features, anchors, power=-2):
+    """
+    constantcoordinatecil的坐标变换: embedding到每个anchor的平方距离的power次方, 一次matmul得到整个batch
+    Args:
+        features: [B, D]
+        anchors: [A, D]
+    Returns:
+        [B, A]
+    """
+    return sq_l2_distances(features, anchors.to(features.device, features.dtype)).pow(power)
+
+
+def load_anchor_bank(path):
+    """
+    读取anchor bank [A, D]: .npy以copy-on-write方式memmap打开(多个进程共享同一份页缓存),
+    旧的 .pth (list of [D] 或 [A, D]) 直接torch.load
+    """
+    if path.endswith('.pth'):
+        anchors = torch.load(path, map_location='cpu')
+        return torch.stack(list(anchors)) if isinstance(anchors, (list, tuple)) else anchors
+    return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+
+def build_anchor_bank(image_root, model, out_path, device='cpu', num_classes=None, batch_size=128, num_workers=4):
+    """
+    从本地图片目录(ImageFolder结构, 每个子目录一个类别)构建anchor bank: 每个类别取backbone特征的均值
+    结果以float32 .npy写入out_path, 先写临时文件再rename, 文件存在即代表完整
+    Args:
+        num_classes: 只取前num_classes个类别(按目录名排序), 缺省为全部
+    """
+    from .data_category import build_transform
+
+    dataset = datasets.ImageFolder(image_root, transform=transforms.Compose(build_transform(is_train=False)))
+    if num_classes is not None:
+        keep = [i for i, target in enumerate(dataset.targets) if target < num_classes]
+        dataset = torch.utils.data.Subset(dataset, keep)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    accumulator = PrototypeAccumulator(device=device)
+    model.to(device).eval()
+    with torch.no_grad():
+        for inputs, targets in loader:
+            accumulator.update(model(inputs.to(device)), targets)
+    anchors = accumulator.protos().cpu().numpy().astype(np.float32)
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    tmp_path = out_path + '.tmp.npy'
+    np.save(tmp_path, anchors)
+    os.replace(tmp_path, out_path)
+    return anchors
+
+
+if __name__ == '__main__':
+    from .weight_registry import create_model
+
+    parser = argparse.ArgumentParser(description='Build the anchor bank used by constantcoordinatecil.')
+    parser.add_argument('--images', type=str, required=True, help='ImageFolder root, one sub-directory per class')
+    parser.add_argument('--out', type=str, required=True, help='output .npy path')
+    parser.add_argument('--model', type=str, default='vit_base_patch16_224')
+    parser.add_argument('--weight-dir', type=str, default=None, help='local weight registry (default: WEIGHT_DIR or ./weights)')
+    parser.add_argument('--num-classes', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=128)
+    parser.add_argument('--num-workers', type=int, default=4)
+    cli = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    network = create_model(cli.model, root=cli.weight_dir)
+    anchors = build_anchor_bank(cli.images, network, cli.out, device=device, num_classes=cli.num_classes,
+                                batch_size=cli.batch_size, num_workers=cli.num_workers)
+    print(f'anchors {anchors.shape} -> {cli.out}')
@@ -0,0 +1,193 @@
+import math
+import time
+import torch
+import torch.nn.functional as F
+
+from .ncm import sq_l2_distances, ncm_topk
+
+
+def _kmeans(x, num_clusters, iters=10, seed=0):
+    # 粗聚类中心: 随机选初始中心 + Lloyd迭代, 只用于划分倒排列表, 不要求收敛
+    generator = torch.Generator(device='cpu').manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator=generator)[:num_clusters].to(x.device)].clone()
+    for _ in range(iters):
+        assign = sq_l2_distances(x, centroids).argmin(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=num_clusters).unsqueeze(1)
+        # 空簇保留原中心
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids
+
+
+class IVFIndex(object):
+    """
+    prototypes上的倒排(IVF)近似最近邻索引, 纯torch实现
+    向量按最近的粗聚类中心划入倒排列表, 查询时只扫描最近的nprobe个列表
+    新任务的prototypes直接分配到已有中心(add), 不重新聚类; 总数增长到上次聚类时的retrain_factor倍后才重新聚类(摊还)
+    数量小于min_train_size时退化为精确的暴力NCM
+    """
+
+    def __init__(self, nprobe=8, num_lists=None, metric='l2', min_train_size=1024, retrain_factor=4.0,
+                 device='cpu', seed=0):
+        if metric not in ('l2', 'cosine'):
+            raise ValueError("Unknown metric {}.".format(metric))
+        self.nprobe = nprobe
+        self.num_lists = num_lists
+        self.metric = metric
+        self.min_train_size = min_train_size
+        self.retrain_factor = retrain_factor
+        self.device = device
+        self.seed = seed
+        self.vectors = None
+        self.centroids = None
+        self.assign = None
+        self._trained_size = 0
+        self._lists = None
+
+    def __len__(self):
+        return 0 if self.vectors is None else len(self.vectors)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _prepare(self, x):
+        x = x.detach().to(self.device, torch.float32)
+        return F.normalize(x, dim=1) if self.metric == 'cosine' else x
+
+    def train(self):
+        """对当前所有向量重新聚类并分配倒排列表"""
+        num_lists = self.num_lists or max(1, int(round(math.sqrt(len(self)))))
+        self.centroids = _kmeans(self.vectors, min(num_lists, len(self)), seed=self.seed)
+        self.assign = sq_l2_distances(self.vectors, self.centroids).argmin(dim=1)
+        self._trained_size = len(self)
+        self._lists = None
+
+    def add(self, prototypes):
+        """追加新的prototypes [n, D], 序号紧接已有向量之后"""
+        x = self._prepare(prototypes)
+        self.vectors = x if self.vectors is None else torch.cat([self.vectors, x])
+        if not self.is_trained:
+            if len(self) >= self.min_train_size:
+                self.train()
+            return
+        if self.retrain_factor is not None and len(self) >= self.retrain_factor * self._trained_size:
+            self.train()
+            return
+        self.assign = torch.cat([self.assign, sq_l2_distances(x, self.centroids).argmin(dim=1)])
+        self._lists = None
+
+    def sync(self, prototypes):
+        """
+        与prototype库同步: 已有的行原地更新(如漂移后的旧类别)并按现有中心重新分配, 多出的行作为新向量add
+        """
+        n = len(self)
+        if n > len(prototypes):
+            raise ValueError("Index has {} vectors, got {} prototypes.".format(n, len(prototypes)))
+        if n > 0:
+            self.vectors = self._prepare(prototypes[:n])
+            if self.is_trained:
+                self.assign = sq_l2_distances(self.vectors, self.centroids).argmin(dim=1)
+                self._lists = None
+        if len(prototypes) > n:
+            self.add(prototypes[n:])
+
+    def _inverted_lists(self):
+        # 按列表序号排序得到CSR形式的倒排列表, 只在add/sync之后的第一次查询时重建
+        if self._lists is None:
+            order = torch.argsort(self.assign, stable=True)
+            counts = torch.bincount(self.assign, minlength=len(self.centroids))
+            offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)]).tolist()
+            self._lists = (order, offsets)
+        return self._lists
+
+    def search(self, features, k=1):
+        """
+        Returns:
+            (scores, indices): [B, k]; 'l2'时scores为 -距离, 'cosine'时为余弦相似度; 候选不足k个时indices补-1
+        """
+        query = self._prepare(features)
+        if not self.is_trained:
+            return ncm_topk(query, self.vectors, k=k, metric=self.metric)
+
+        k = min(k, len(self))
+        order, offsets = self._inverted_lists()
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = torch.topk(-sq_l2_distances(query, self.centroids), k=nprobe, dim=1).indices
+
+        best_distances = torch.full((len(query), k), float('inf'), device=query.device)
+        best_indices = torch.full((len(query), k), -1, dtype=torch.long, device=query.device)
+        for list_id in torch.unique(probes).tolist():
+            members = order[offsets[list_id]:offsets[list_id + 1]]
+            if len(members) == 0:
+                continue
+            rows = (probes == list_id).any(dim=1).nonzero().squeeze(-1)
+            distances = sq_l2_distances(query[rows], self.vectors[members])
+
+            # 与已有候选合并
+            distances = torch.cat([best_distances[rows], distances], dim=1)
+            indices = torch.cat([best_indices[rows], members.expand(len(rows), -1)], dim=1)
+            distances, top = torch.topk(distances, k=k, dim=1, largest=False)
+            best_distances[rows], best_indices[rows] = distances, indices.gather(1, top)
+
+        distances = best_distances.sqrt()
+        scores = 1 - best_distances / 2 if self.metric == 'cosine' else -distances
+        return scores, best_indices
+
+
+def benchmark(prototypes, queries, k_list=(1, 5), nprobe_list=(1, 2, 4, 8, 16, 32), metric='l2', repeats=3):
+    """
+    对比IVF检索与精确NCM: recall@k(精确top-k中被检索到的比例) 与每条查询的平均耗时
+    Returns:
+        list of dict: 每个nprobe一行, 第一行为精确NCM
+    """
+    k_max = max(k_list)
+
+    def timed(fn):
+        fn()
+        # 等预热的kernel执行完再计时, 避免计入重复测量
+        if queries.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            result = fn()
+        if queries.is_cuda:
+            torch.cuda.synchronize()
+        return result, (time.perf_counter() - start) / repeats / len(queries) * 1e3
+
+    (_, exact), exact_ms = timed(lambda: ncm_topk(queries, prototypes, k=k_max, metric=metric))
+    rows = [{'nprobe': 'exact', 'ms/query': exact_ms, **{f'recall@{k}': 1.0 for k in k_list}}]
+
+    index = IVFIndex(metric=metric, min_train_size=0, device=prototypes.device)
+    index.add(prototypes)
+    for nprobe in nprobe_list:
+        index.nprobe = nprobe
+        (_, found), ms = timed(lambda: index.search(queries, k=k_max))
+        row = {'nprobe': nprobe, 'ms/query': ms}
+        for k in k_list:
+            hit = (found[:, :k].unsqueeze(2) == exact[:, :k].unsqueeze(1)).any(dim=1)
+            row[f'recall@{k}'] = hit.float().mean().item()
+        rows.append(row)
+    return rows
+
+
+def report(prototypes, queries, **kwargs):
+    rows = benchmark(prototypes, queries, **kwargs)
+    keys = list(rows[0].keys())
+    print(' | '.join(f'{key:>10}' for key in keys))
+    for row in rows:
+        print(' | '.join(f'{row[key]:>10.4f}' if isinstance(row[key], float) else f'{row[key]:>10}' for key in keys))
+    return rows
+
+
+if __name__ == '__main__':
+    # 在仓库根目录以 python -m utils.ann 运行(模块使用包内相对导入)
+    # 模拟ViT特征: 每个类别一个prototype, 查询为类别中心附近的样本
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    for num_classes in (1000, 10000):
+        prototypes = torch.randn(num_classes, 768, device=device)
+        labels = torch.randint(0, num_classes, (1024,), device=device)
+        queries = prototypes[labels] + 0.8 * torch.randn(1024, 768, device=device)
+        print(f'classes={num_classes}')
+        report(prototypes, queries)
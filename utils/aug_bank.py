@@ -0,0 +1,78 @@
+import os
+import atexit
+import shutil
+import tempfile
+import numpy as np
+import torch
+from tqdm import tqdm
+
+
+class AugmentationBank(object):
+    """
+    固定的强增强视图库: 每个任务开始时从sa_loader取bank_size个强增强视图, 连同旧网络(旧prompt)在其上的输出
+    一起以fp16 memmap写入磁盘; 训练时一致性(MSE)项只需对随机取出的视图做新网络前向, 旧网络的前向不再重复
+    旧网络在任务内不变, 因此同一任务内多次train_vpt可复用同一个bank
+    文件写在cache_dir下本次运行独有的临时目录中, 任务结束(close)或进程退出时删除
+    """
+
+    def __init__(self, cache_dir, bank_size, device='cpu', seed=0):
+        self.cache_dir = cache_dir
+        self.root = None
+        self.bank_size = bank_size
+        self.device = device
+        self.generator = torch.Generator().manual_seed(seed)
+        self.images = None
+        self.targets = None
+        atexit.register(self.close)
+
+    def __len__(self):
+        return 0 if self.targets is None else len(self.targets)
+
+    def close(self):
+        """释放memmap并删除bank目录"""
+        self.images = self.targets = None
+        if self.root is not None:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root = None
+
+    def build(self, data_loader, old_model):
+        """
+        Args:
+            data_loader: 强增强的loader, 产出 (idx, inputs, targets)
+            old_model: 旧网络, 只做推理
+        """
+        # 先释放上一个任务的memmap(Windows下映射中的文件不能重新以w+打开), 再写入新的临时目录
+        self.close()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.root = tempfile.mkdtemp(prefix='aug_bank_', dir=self.cache_dir)
+        images, targets, count = None, None, 0
+        was_training = old_model.training
+        old_model.eval()
+        with torch.no_grad(), tqdm(total=self.bank_size, desc="Augmentation Bank", ncols=120) as pbar:
+            while count < self.bank_size:
+                for _, inputs, _ in data_loader:
+                    inputs = inputs[:self.bank_size - count]
+                    outputs = old_model(inputs.to(self.device))
+                    if images is None:
+                        images = np.memmap(os.path.join(self.root, 'images.f16'), dtype=np.float16, mode='w+',
+                                           shape=(self.bank_size,) + tuple(inputs.shape[1:]))
+                        targets = np.memmap(os.path.join(self.root, f'targets_{outputs.shape[1]}.f16'),
+                                            dtype=np.float16, mode='w+', shape=(self.bank_size, outputs.shape[1]))
+                    images[count:count + len(inputs)] = inputs.cpu().to(torch.float16).numpy()
+                    targets[count:count + len(inputs)] = outputs.cpu().to(torch.float16).numpy()
+                    count += len(inputs)
+                    pbar.update(len(inputs))
+                    if count >= self.bank_size:
+                        break
+        old_model.train(was_training)
+        images.flush()
+        targets.flush()
+        self.images, self.targets = images, targets
+        return self
+
+    def sample(self, batch_size):
+        """随机取一个batch: (视图 [B, C, H, W], 旧网络输出 [B, D]), 均为设备上的float32"""
+        idx = torch.randint(len(self), (min(batch_size, len(self)),), generator=self.generator).sort().values.numpy()
+        inputs = torch.from_numpy(self.images[idx].astype(np.float32))
+        old_outputs = torch.from_numpy(self.targets[idx].astype(np.float32))
+        return inputs.to(self.device, non_blocking=True), old_outputs.to(self.device, non_blocking=True)
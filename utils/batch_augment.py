@@ -0,0 +1,211 @@
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torchvision import transforms
+
+
+class BatchTransform(object):
+    """
+    批量张量空间数据增强, 在计算设备上一次性完成整个batch的 crop + resize + flip + ToTensor + Normalize
+    输入为DataLoader拼接好的原始分辨率uint8图片 [B, C, H, W], 输出与逐样本PIL transforms统计一致的float张量
+    crop与resize合并为一次affine_grid + grid_sample, 每个样本的裁剪框/翻转编码在各自的仿射矩阵中
+    """
+
+    def __init__(self, output_size=224, random_crop=False, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.),
+                 resize_size=None, interpolation='bilinear', flip_p=0.0, mean=None, std=None):
+        self.output_size = output_size
+        self.random_crop = random_crop
+        self.scale = scale
+        self.ratio = ratio
+        self.resize_size = resize_size
+        self.interpolation = interpolation
+        self.flip_p = flip_p
+        self.mean = mean
+        self.std = std
+
+    @classmethod
+    def from_transforms(cls, trsf_list):
+        """
+        由data_category中的transforms列表构建等价的BatchTransform
+        支持 RandomResizedCrop / Resize / CenterCrop / RandomHorizontalFlip / ToTensor / Normalize,
+        含其它transform(如StrongAugmentation, ColorJitter)时返回None, 由调用方退回逐样本PIL流程
+        """
+        kwargs = {}
+        for t in trsf_list:
+            if isinstance(t, transforms.RandomResizedCrop):
+                kwargs.update(output_size=t.size[0], random_crop=True, scale=tuple(t.scale), ratio=tuple(t.ratio),
+                              interpolation=_grid_mode(t.interpolation))
+            elif isinstance(t, transforms.Resize):
+                if not isinstance(t.size, int) and len(t.size) != 1:
+                    return None
+                kwargs.update(resize_size=t.size if isinstance(t.size, int) else t.size[0],
+                              interpolation=_grid_mode(t.interpolation))
+            elif isinstance(t, transforms.CenterCrop):
+                kwargs.update(output_size=t.size[0])
+            elif isinstance(t, transforms.RandomHorizontalFlip):
+                kwargs.update(flip_p=t.p)
+            elif isinstance(t, transforms.Normalize):
+                kwargs.update(mean=tuple(t.mean), std=tuple(t.std))
+            elif isinstance(t, transforms.ToTensor):
+                continue
+            else:
+                return None
+        return cls(**kwargs)
+
+    def __call__(self, images):
+        B, _, H, W = images.shape
+        device = images.device
+
+        if self.random_crop:
+            boxes = self._random_resized_crop_boxes(B, H, W, device)
+        else:
+            boxes = self._center_crop_boxes(B, H, W, device)
+
+        # 裁剪框(top, left, h, w, 像素单位)转为align_corners=False下的归一化仿射参数
+        top, left, h, w = boxes.unbind(1)
+        sx, sy = w / W, h / H
+        cx, cy = (2 * left + w) / W - 1, (2 * top + h) / H - 1
+        if self.flip_p > 0:
+            flip = torch.rand(B, device=device) < self.flip_p
+            sx = torch.where(flip, -sx, sx)
+
+        theta = torch.zeros(B, 2, 3, device=device)
+        theta[:, 0, 0], theta[:, 0, 2] = sx, cx
+        theta[:, 1, 1], theta[:, 1, 2] = sy, cy
+        grid = F.affine_grid(theta, [B, 3, self.output_size, self.output_size], align_corners=False)
+
+        # ToTensor: [0, 255] -> [0, 1]; bicubic会有过冲, 与PIL一致截断到合法像素范围
+        x = F.grid_sample(images.float(), grid, mode=self.interpolation, padding_mode='border', align_corners=False)
+        x = x.clamp_(0, 255).div_(255.)
+
+        if self.mean is not None:
+            mean = torch.tensor(self.mean, device=device).view(1, -1, 1, 1)
+            std = torch.tensor(self.std, device=device).view(1, -1, 1, 1)
+            x = (x - mean) / std
+        return x
+
+    def _center_crop_boxes(self, B, H, W, device):
+        # Resize(短边resize_size) + CenterCrop(output_size), 换算回原图坐标系下的居中裁剪框
+        size = self.output_size
+        if self.resize_size is not None:
+            factor = self.resize_size / min(H, W)
+            h, w = min(size / factor, H), min(size / factor, W)
+        else:
+            h, w = min(size, H), min(size, W)
+        box = torch.tensor([(H - h) / 2, (W - w) / 2, h, w], device=device, dtype=torch.float32)
+        return box.expand(B, 4)
+
+    def _random_resized_crop_boxes(self, B, H, W, device, attempts=10):
+        # 与RandomResizedCrop.get_params相同的采样规则, 对整个batch的10次尝试一次性向量化
+        area = H * W
+        log_ratio = torch.log(torch.tensor(self.ratio, device=device))
+        target_area = area * torch.empty(B, attempts, device=device).uniform_(self.scale[0], self.scale[1])
+        aspect_ratio = torch.exp(torch.empty(B, attempts, device=device).uniform_(log_ratio[0], log_ratio[1]))
+        w = torch.round(torch.sqrt(target_area * aspect_ratio))
+        h = torch.round(torch.sqrt(target_area / aspect_ratio))
+        valid = (w > 0) & (w <= W) & (h > 0) & (h <= H)
+
+        # 取每个样本第一次合法的尝试
+        first = torch.argmax(valid.int(), dim=1, keepdim=True)
+        w, h = w.gather(1, first).squeeze(1), h.gather(1, first).squeeze(1)
+        ok = valid.any(dim=1)
+
+        # 全部失败时退回中心裁剪(与torchvision一致按ratio截断)
+        in_ratio = W / H
+        if in_ratio < min(self.ratio):
+            fw, fh = W, round(W / min(self.ratio))
+        elif in_ratio > max(self.ratio):
+            fw, fh = round(H * max(self.ratio)), H
+        else:
+            fw, fh = W, H
+        w = torch.where(ok, w, torch.full_like(w, fw))
+        h = torch.where(ok, h, torch.full_like(h, fh))
+
+        u = torch.rand(B, 2, device=device)
+        top = torch.where(ok, torch.floor(u[:, 0] * (H - h + 1)), torch.full_like(h, (H - fh) // 2))
+        left = torch.where(ok, torch.floor(u[:, 1] * (W - w + 1)), torch.full_like(w, (W - fw) // 2))
+        return torch.stack([top, left, h, w], dim=1)
+
+
+def _grid_mode(interpolation):
+    # PIL/torchvision插值方式 -> grid_sample的mode, int形式为PIL常量(0: NEAREST, 2: BILINEAR, 3: BICUBIC)
+    if isinstance(interpolation, int):
+        return {0: 'nearest', 3: 'bicubic'}.get(interpolation, 'bilinear')
+    if interpolation == transforms.InterpolationMode.BICUBIC:
+        return 'bicubic'
+    if interpolation == transforms.InterpolationMode.NEAREST:
+        return 'nearest'
+    return 'bilinear'
+
+
+class BatchTransformLoader(object):
+    """包装DataLoader: 取出原始uint8 batch后搬到设备上, 再执行BatchTransform"""
+
+    def __init__(self, loader, batch_trsf, device):
+        self.loader = loader
+        self.batch_trsf = batch_trsf
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+    def __iter__(self):
+        for idx, images, labels in self.loader:
+            images = images.to(self.device, non_blocking=True)
+            yield idx, self.batch_trsf(images), labels
+
+
+def benchmark(images, trsf_list, batch_size=128, num_batches=4, device='cpu'):
+    """
+    比较逐样本PIL transforms与BatchTransform的吞吐量
+    Args:
+        images: 原始uint8图片 [N, H, W, 3]
+        trsf_list: transforms列表(须能被BatchTransform.from_transforms支持)
+    Returns:
+        (pil_ips, batch_ips): 两种方式的 images/sec
+    """
+    pil_trsf = transforms.Compose(trsf_list)
+    batch_trsf = BatchTransform.from_transforms(trsf_list)
+    n = min(len(images), batch_size * num_batches)
+
+    start = time.perf_counter()
+    for i in range(0, n, batch_size):
+        batch = torch.stack([pil_trsf(Image.fromarray(img)) for img in images[i:i + batch_size]])
+        batch = batch.to(device)
+    pil_ips = n / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, n, batch_size):
+        batch = torch.from_numpy(np.ascontiguousarray(images[i:i + batch_size])).permute(0, 3, 1, 2)
+        batch = batch_trsf(batch.to(device))
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    batch_ips = n / (time.perf_counter() - start)
+
+    return pil_ips, batch_ips
+
+
+def report_speed(images, trsf_list, batch_size=128, num_batches=4, device='cpu', words='Batch augment'):
+    pil_ips, batch_ips = benchmark(images, trsf_list, batch_size, num_batches, device)
+    print(f'{words}: PIL {pil_ips:.1f} img/s, batched {batch_ips:.1f} img/s, speedup x{batch_ips / pil_ips:.2f}')
+    return pil_ips, batch_ips
+
+
+if __name__ == '__main__':
+    # 用随机的CIFAR尺寸图片测试吞吐量
+    from data_category import build_transform
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    fake_images = np.random.randint(0, 256, size=(512, 32, 32, 3), dtype=np.uint8)
+    report_speed(fake_images, build_transform(is_train=True), device=device, words='train')
+    report_speed(fake_images, build_transform(is_train=False), device=device, words='test')
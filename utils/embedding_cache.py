@@ -0,0 +1,77 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+# 这些参数即使requires_grad=False(如merge后的adapter)也会改变输出, 必须计入指纹
+TUNED_KEYS = ('Prompt_Tokens', 'cur_adapter')
+
+
+def model_fingerprint(model, backbone_id=None, forward_name='forward'):
+    """
+    模型指纹: backbone标识 + 可调参数(prompt/adapter/requires_grad的参数)内容的哈希
+    冻结的预训练权重由backbone_id代表, 不逐元素哈希
+    """
+    backbone_id = backbone_id if backbone_id is not None else type(model).__name__
+    digest = hashlib.sha1(f'{backbone_id}-{type(model).__name__}-{forward_name}'.encode())
+    for name, param in model.named_parameters():
+        if param.requires_grad or any(key in name for key in TUNED_KEYS):
+            digest.update(name.encode())
+            digest.update(param.detach().float().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+class EmbeddingTable(object):
+    """
+    某个(模型指纹, 数据集, source, mode)下的embedding表, fp16 memmap [num_samples, dim], 按sample_id索引
+    """
+
+    def __init__(self, root, num_samples, dim):
+        self.num_samples = num_samples
+        self.dim = dim
+        self.data_path = os.path.join(root, f'emb_{dim}.f16')
+        self.filled_path = os.path.join(root, 'filled.u8')
+        if not os.path.exists(self.filled_path):
+            os.makedirs(root, exist_ok=True)
+            np.memmap(self.data_path, dtype=np.float16, mode='w+', shape=(max(num_samples, 1), dim)).flush()
+            np.memmap(self.filled_path + '.tmp', dtype=np.uint8, mode='w+', shape=(max(num_samples, 1),)).flush()
+            os.replace(self.filled_path + '.tmp', self.filled_path)
+        self.data = np.memmap(self.data_path, dtype=np.float16, mode='r+').reshape(-1, dim)
+        self.filled = np.memmap(self.filled_path, dtype=np.uint8, mode='r+')
+
+    def hit(self, sample_ids):
+        return self.filled[sample_ids].astype(bool)
+
+    def get(self, sample_ids):
+        return torch.from_numpy(self.data[sample_ids].astype(np.float32))
+
+    def put(self, sample_ids, embeddings):
+        self.data[sample_ids] = embeddings.detach().cpu().to(torch.float16).numpy()
+        self.filled[sample_ids] = 1
+
+
+class EmbeddingCache(object):
+    """
+    内容寻址的embedding缓存, 键为 (backbone标识, prompt/adapter哈希, transform模式, sample_id)
+    只有确定性模式(test/flip)的数据集才带有 embedding_key, 随机增强的数据集不会被缓存
+    """
+
+    def __init__(self, cache_dir, max_open_tables=8):
+        self.root = os.path.join(cache_dir, 'embeddings')
+        self.max_open_tables = max_open_tables
+        self._tables = OrderedDict()
+
+    def table(self, model_key, dataset, dim):
+        data_key = getattr(dataset, 'embedding_key', None)
+        if data_key is None or dim is None:
+            return None
+        key = (model_key, data_key, dim)
+        if key not in self._tables:
+            root = os.path.join(self.root, data_key, model_key)
+            self._tables[key] = EmbeddingTable(root, len(dataset.images), dim)
+            # 只保留最近使用的若干张表的映射
+            while len(self._tables) > self.max_open_tables:
+                self._tables.popitem(last=False)
+        self._tables.move_to_end(key)
+        return self._tables[key]
@@ -0,0 +1,186 @@
+import os
+import hashlib
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+from torchvision import transforms
+
+
+def find_resize(trsf_list):
+    """
+    从测试transforms中找到第一个Resize, 返回(size, interpolation); 找不到则返回(None, None)
+    """
+    for t in trsf_list:
+        if isinstance(t, transforms.Resize):
+            size = t.size if isinstance(t.size, int) else t.size[0]
+            return size, t.interpolation
+    return None, None
+
+
+def resized_shape(w, h, size):
+    """与transforms.Resize(int)一致: 短边缩放到size, 长边按比例取整"""
+    short, long = (w, h) if w <= h else (h, w)
+    new_short, new_long = size, int(size * long / short)
+    return (new_short, new_long) if w <= h else (new_long, new_short)
+
+
+def data_digest(data, extra=''):
+    """数据集内容的摘要: 路径型数据按路径列表, 内存型数据按像素内容, 用作缓存键"""
+    digest = hashlib.sha1(str(extra).encode())
+    if data.dtype.kind in 'USO':
+        for path in data:
+            digest.update(str(path).encode())
+            digest.update(b'\0')
+    else:
+        digest.update(str(data.shape).encode())
+        digest.update(memoryview(np.ascontiguousarray(data)).cast('B'))
+    return digest.hexdigest()[:16]
+
+
+def _pil_interpolation(interpolation):
+    # torchvision的InterpolationMode与PIL常量之间的转换, 兼容直接传int(如interpolation=3)
+    if isinstance(interpolation, int):
+        return interpolation
+    return transforms.functional.pil_modes_mapping[interpolation]
+
+
+class DecodedImageCache(object):
+    """
+    use_path数据集的解码图片缓存
+    每张图片只解码一次, 缩放到测试resize分辨率后以uint8连续存放在一个memmap文件中,
+    sidecar索引 index.npy 记录每张图片的 (offset, h, w)
+    缓存以只读方式打开, 多个进程(DataLoader workers / 多个实验)可共享同一份文件
+    图片已缩小到测试分辨率, 只供确定性模式(test/flip)使用; 随机增强的train/strong模式仍读取原图
+    """
+
+    def __init__(self, cache_dir, paths, size=256, interpolation=Image.BICUBIC):
+        self.size = size
+        self.interpolation = _pil_interpolation(interpolation)
+
+        # 以路径列表+分辨率为键, 数据集划分或顺序变化时自动使用新的缓存
+        digest = data_digest(np.asarray(paths), extra=f'{size}-{self.interpolation}')
+        self.root = os.path.join(cache_dir, f'images_{digest}')
+        self.data_path = os.path.join(self.root, 'images.u8')
+        self.index_path = os.path.join(self.root, 'index.npy')
+
+        # index.npy最后写入, 存在即代表缓存完整
+        if not os.path.exists(self.index_path):
+            self._build(paths)
+        self.index = np.load(self.index_path)
+        self._data = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if self._data is None:
+            # 延迟打开, 保证fork/spawn出的worker各自映射同一文件而不是拷贝
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        offset, h, w = self.index[i]
+        return self._data[offset:offset + h * w * 3].reshape(h, w, 3)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def _build(self, paths):
+        os.makedirs(self.root, exist_ok=True)
+
+        # 第一遍只读文件头得到尺寸, 确定每张图片在memmap中的偏移
+        index = np.zeros((len(paths), 3), dtype=np.int64)
+        offset = 0
+        for i, path in enumerate(tqdm(paths, desc="Scan images", ncols=120)):
+            with Image.open(path) as img:
+                w, h = resized_shape(*img.size, self.size)
+            index[i] = (offset, h, w)
+            offset += h * w * 3
+
+        # 第二遍解码+缩放并写入, 先写临时文件再rename, 避免其他进程读到半成品
+        tmp_suffix = f'.tmp{os.getpid()}'
+        data = np.memmap(self.data_path + tmp_suffix, dtype=np.uint8, mode='w+', shape=(max(offset, 1),))
+        for i, path in enumerate(tqdm(paths, desc="Decode images", ncols=120)):
+            with open(path, 'rb') as f:
+                img = Image.open(f)
+                img = img.convert('RGB')
+            start, h, w = index[i]
+            img = img.resize((int(w), int(h)), self.interpolation)
+            data[start:start + h * w * 3] = np.asarray(img, dtype=np.uint8).reshape(-1)
+        data.flush()
+        del data
+
+        os.replace(self.data_path + tmp_suffix, self.data_path)
+        with open(self.index_path + tmp_suffix, 'wb') as f:
+            np.save(f, index)
+        os.replace(self.index_path + tmp_suffix, self.index_path)
+
+
+def split_deterministic(trsf_list):
+    """
+    将测试transforms列表在ToTensor处拆分: 之前为确定性的PIL操作(Resize/CenterCrop), 之后为张量操作
+    Returns:
+        (pre_list, post_list, shape): shape为pre输出的 (h, w, 3); 无法确定输出尺寸时返回None
+    """
+    for i, t in enumerate(trsf_list):
+        if isinstance(t, transforms.ToTensor):
+            pre_list, post_list = trsf_list[:i], trsf_list[i:]
+            break
+    else:
+        return None
+    for t in pre_list:
+        if not isinstance(t, (transforms.Resize, transforms.CenterCrop)):
+            return None
+    crops = [t for t in pre_list if isinstance(t, transforms.CenterCrop)]
+    if not crops:
+        return None
+    h, w = crops[-1].size
+    return pre_list, post_list, (h, w, 3)
+
+
+class PreprocessedImageCache(object):
+    """
+    测试transforms确定性部分(Resize/CenterCrop)输出的uint8缓存, 按sample_id索引, 存放于memmap
+    样本首次被访问时计算并写入, 之后的epoch/任务/运行直接读取; 因此新任务只需处理新增类别的样本
+    flip在ToTensor之后的张量上完成, 所以mode="test"与mode="flip"共用同一份缓存
+    """
+
+    def __init__(self, cache_dir, key, num_samples, shape, pre_trsf):
+        self.pre_trsf = pre_trsf
+        self.shape = tuple(shape)
+        self.root = os.path.join(cache_dir, f'tensors_{key}')
+        self.data_path = os.path.join(self.root, 'data.u8')
+        self.filled_path = os.path.join(self.root, 'filled.u8')
+
+        # 在主进程中创建文件, worker进程只以r+方式映射
+        if not os.path.exists(self.filled_path):
+            os.makedirs(self.root, exist_ok=True)
+            np.memmap(self.data_path, dtype=np.uint8, mode='w+', shape=(max(num_samples, 1), *self.shape)).flush()
+            np.memmap(self.filled_path + '.tmp', dtype=np.uint8, mode='w+', shape=(max(num_samples, 1),)).flush()
+            os.replace(self.filled_path + '.tmp', self.filled_path)
+        self.num_samples = num_samples
+        self._data, self._filled = None, None
+
+    def __len__(self):
+        return self.num_samples
+
+    def _open(self):
+        self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r+').reshape(-1, *self.shape)
+        self._filled = np.memmap(self.filled_path, dtype=np.uint8, mode='r+')
+
+    def fetch(self, sample_id, load_image):
+        """
+        返回样本的预处理结果 [h, w, 3] uint8, 未命中时由 load_image(sample_id) 取PIL图片计算后写入
+        """
+        if self._data is None:
+            self._open()
+        if self._filled[sample_id]:
+            return np.array(self._data[sample_id])
+        image = np.array(self.pre_trsf(load_image(sample_id)), dtype=np.uint8)
+        self._data[sample_id] = image
+        self._filled[sample_id] = 1
+        return image
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'], state['_filled'] = None, None
+        return state
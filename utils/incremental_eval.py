@@ -0,0 +1,53 @@
+import torch
+from tqdm import tqdm
+
+from .toolkits import extract_embeddings
+
+
+class TestFeatureStore(object):
+    """
+    冻结backbone的learner(simplecil, kmeanscil等)的测试集特征: 旧类别测试样本的embedding每个任务都不变,
+    因此每个任务只对新增类别的测试样本做前向并追加, 再用更新后的prototypes对全部特征重新打分
+    启用该模式时learner的test_loader只含当前任务新增类别的测试样本; 按任务记录, 同一任务重复评估不会重复追加
+    """
+
+    def __init__(self, device='cpu'):
+        self.device = device
+        self.features = None
+        self.labels = None
+        self.tasks = set()
+
+    def __len__(self):
+        return 0 if self.labels is None else len(self.labels)
+
+    def add(self, task_id, data_loader, model, forward=None, cache=None, backbone_id=None):
+        """提取第task_id个任务的data_loader(只含新类别的测试样本)的embedding并追加, 该任务已保存时跳过"""
+        if task_id in self.tasks:
+            return self
+        self.tasks.add(task_id)
+        embeddings, labels = extract_embeddings(data_loader, self.device, model, forward=forward, cache=cache,
+                                                backbone_id=backbone_id, desc="Test Inference")
+        embeddings = embeddings.to(self.device)
+        self.features = embeddings if self.features is None else torch.cat([self.features, embeddings])
+        self.labels = labels if self.labels is None else torch.cat([self.labels, labels])
+        return self
+
+    def batches(self, batch_size=1024):
+        """按batch产出全部已保存的 (embeddings, labels)"""
+        for start in range(0, len(self), batch_size):
+            yield self.features[start:start + batch_size], self.labels[start:start + batch_size]
+
+
+def iter_test_outputs(data_loader, device, model, store=None, task_id=None, forward=None, cache=None, backbone_id=None):
+    """
+    逐batch产出测试集的 (embeddings, targets), 需在torch.no_grad()下调用
+    给定store(增量评估)时data_loader只含第task_id个任务新类别的测试样本: 该任务尚未保存时先提取并追加到store,
+    再产出store中的全部特征; 否则对data_loader逐batch前向
+    """
+    forward = forward if forward is not None else model
+    if store is None:
+        for _, inputs, targets in tqdm(data_loader):
+            yield forward(inputs.to(device)), targets
+        return
+    store.add(task_id, data_loader, model, forward=forward, cache=cache, backbone_id=backbone_id)
+    yield from store.batches(data_loader.batch_size)
@@ -0,0 +1,152 @@
+import json
+import os
+import numpy as np
+import torch
+
+
+class AccuracyMeter(object):
+    """
+    设备端的流式准确率统计: 累计top-k正确数与混淆矩阵(按top-1预测), 每个batch的更新为O(B)且不与host同步
+    只有调用accuracy()/per_class_accuracy()等读取结果时才同步, 进度条用 should_report() 每report_every个batch刷新一次
+    top-1预测为-1(如simplecil置信度规则拒绝)的样本记为错误, 不计入混淆矩阵
+    keep_predictions=True时同时在设备上保留每个样本的top-1预测与标签, 供 TaskAccuracyMatrix 按任务统计
+    """
+
+    def __init__(self, num_classes=0, top_ks=(1,), device='cpu', report_every=10, keep_predictions=False):
+        self.top_ks = tuple(top_ks)
+        self.device = device
+        self.report_every = report_every
+        self.num_batches = 0
+        self.total = torch.zeros((), dtype=torch.long, device=device)
+        self.correct = torch.zeros(len(self.top_ks), dtype=torch.long, device=device)
+        self.confusion = torch.zeros(num_classes, num_classes, dtype=torch.long, device=device)
+        self.keep_predictions = keep_predictions
+        self._preds, self._targets = [], []
+
+    @property
+    def num_classes(self):
+        return len(self.confusion)
+
+    def _grow(self, num_classes):
+        # 类别数随任务增长时扩大混淆矩阵, 原有计数保留在左上角
+        if num_classes <= self.num_classes:
+            return
+        confusion = torch.zeros(num_classes, num_classes, dtype=torch.long, device=self.device)
+        confusion[:self.num_classes, :self.num_classes] = self.confusion
+        self.confusion = confusion
+
+    def update(self, top_indices, targets, num_classes=None):
+        """
+        Args:
+            top_indices: [B, k] 预测类别(从高到低), 或 [B] 的top-1预测
+            targets: [B]
+            num_classes: 类别总数, 缺省时按 targets.max() + 1 扩展(会同步一次)
+        """
+        top_indices = top_indices.to(self.device)
+        if top_indices.dim() == 1:
+            top_indices = top_indices.unsqueeze(1)
+        targets = targets.to(self.device).long()
+        self._grow(num_classes if num_classes is not None else int(targets.max()) + 1)
+
+        hits = top_indices == targets.unsqueeze(1)
+        for i, k in enumerate(self.top_ks):
+            self.correct[i] += hits[:, :k].any(dim=1).sum()
+        self.total += len(targets)
+
+        preds = top_indices[:, 0]
+        valid = (preds >= 0) & (preds < self.num_classes)
+        flat = targets[valid] * self.num_classes + preds[valid]
+        self.confusion.view(-1).index_add_(0, flat, torch.ones_like(flat))
+        if self.keep_predictions:
+            self._preds.append(preds)
+            self._targets.append(targets)
+        self.num_batches += 1
+        return self
+
+    def should_report(self):
+        """最近一次update后是否到了刷新进度条的时机"""
+        return self.num_batches % self.report_every == 0
+
+    def accuracy(self, k=1):
+        """top-k准确率(%)"""
+        total = int(self.total)
+        return 100 * int(self.correct[self.top_ks.index(k)]) / total if total > 0 else 0.
+
+    def per_class_accuracy(self):
+        """每个类别的top-1准确率(%) [num_classes], 没有样本的类别为nan"""
+        support = self.confusion.sum(dim=1)
+        return 100 * self.confusion.diagonal().double() / support.double()
+
+    def predictions(self):
+        """keep_predictions时记录的 (top-1预测, 标签), 均为CPU上的 [N]"""
+        if not self._preds:
+            return torch.zeros(0, dtype=torch.long), torch.zeros(0, dtype=torch.long)
+        return torch.cat(self._preds).cpu(), torch.cat(self._targets).cpu()
+
+    def reset(self):
+        self.num_batches = 0
+        self._preds, self._targets = [], []
+        self.total.zero_()
+        self.correct.zero_()
+        self.confusion.zero_()
+        return self
+
+
+class TaskAccuracyMatrix(object):
+    """
+    由每个任务结束时测试集上的逐样本top-1预测得到 T×T 准确率矩阵: acc[t][j] 为学完任务t后在任务j的类别上的准确率(%)
+    类别按增量顺序编号, 任务j的类别为 [offsets[j], offsets[j + 1]); 只使用已有的测试预测, 不需要额外的前向
+    """
+
+    def __init__(self, increments):
+        self.increments = [int(size) for size in increments]
+        self.offsets = np.concatenate([[0], np.cumsum(self.increments)])
+        self.num_tasks = len(self.increments)
+        self.matrix = np.full((self.num_tasks, self.num_tasks), np.nan)
+        self.overall = np.full(self.num_tasks, np.nan)
+
+    def task_of(self, targets):
+        """类别 -> 任务序号"""
+        return np.searchsorted(self.offsets, np.asarray(targets), side='right') - 1
+
+    def record(self, task, preds, targets):
+        """记录学完第task个任务后的测试预测 preds/targets [N]"""
+        preds, targets = np.asarray(preds), np.asarray(targets)
+        correct = preds == targets
+        tasks = self.task_of(targets)
+        counts = np.bincount(tasks, minlength=self.num_tasks)[:self.num_tasks]
+        hits = np.bincount(tasks, weights=correct, minlength=self.num_tasks)[:self.num_tasks]
+        seen = counts > 0
+        self.matrix[task, seen] = 100 * hits[seen] / counts[seen]
+        self.overall[task] = 100 * correct.mean() if len(correct) > 0 else np.nan
+        return self.matrix[task]
+
+    def summary(self):
+        """
+        average_incremental_accuracy: 各任务结束时整体准确率的均值
+        forgetting: 旧任务历史最佳准确率与最终准确率之差的均值
+        backward_transfer: 旧任务最终准确率与刚学完时准确率之差的均值(负数为遗忘)
+        """
+        done = np.flatnonzero(~np.isnan(self.overall))
+        result = {
+            'increments': self.increments,
+            'accuracy_matrix': [[None if np.isnan(v) else float(v) for v in row] for row in self.matrix],
+            'accuracy_curve': [float(self.overall[t]) for t in done],
+        }
+        if len(done) == 0:
+            return result
+        last = done[-1]
+        result['average_incremental_accuracy'] = float(np.mean(self.overall[done]))
+        result['last_accuracy'] = float(self.overall[last])
+        old = [j for j in range(last) if not np.isnan(self.matrix[last, j])]
+        if old:
+            best = [np.nanmax(self.matrix[:last, j]) for j in old]
+            result['forgetting'] = float(np.mean([b - self.matrix[last, j] for b, j in zip(best, old)]))
+            result['backward_transfer'] = float(np.mean([self.matrix[last, j] - self.matrix[j, j] for j in old]))
+        return result
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        return path
@@ -0,0 +1,206 @@
+import torch
+import torch.nn.functional as F
+
+
+def sq_l2_distances(features, prototypes, proto_sq_norms=None):
+    """
+    平方L2距离 ||x||^2 - 2x·p + ||p||^2, 主要计算量为一次matmul
+    Args:
+        features: [B, D]
+        prototypes: [C, D]
+        proto_sq_norms: 预先计算的 ||p||^2 [C] (如PrototypeBank.sq_norms), 缺省时现场计算
+    Returns:
+        [B, C]
+    """
+    if proto_sq_norms is None:
+        proto_sq_norms = prototypes.pow(2).sum(dim=1)
+    distances = features.pow(2).sum(dim=1, keepdim=True) - 2 * features @ prototypes.t() + proto_sq_norms
+    return distances.clamp(min=0)
+
+
+def ncm_topk(features, prototypes, k=1, metric='l2', chunk_size=1024, proto_sq_norms=None, slack=4):
+    """
+    分块的精确NCM top-k: 类别维度按chunk_size分块计算, 与当前保留的候选合并后再取top-k,
+    峰值显存为 O(B·(chunk_size + k)), 与类别总数无关
+    Args:
+        metric: 'l2' 按欧氏距离从小到大; 'cosine' 按余弦相似度从大到小
+        proto_sq_norms: 'l2'时可传入缓存的 ||p||^2 [C]
+        slack: 'l2'时多保留的候选数; matmul展开式存在舍入误差, 候选最后用逐元素差值重新计算距离并排序,
+               保证与 torch.topk(-torch.cdist(features, prototypes), k) 的排名一致
+    Returns:
+        (scores, indices): [B, k]; 'l2'时scores为 -距离(与 -cdist 相同), 'cosine'时为余弦相似度
+    """
+    num_classes = prototypes.size(0)
+    k = min(k, num_classes)
+    keep = min(k + slack, num_classes) if metric == 'l2' else k
+    if metric == 'l2':
+        if proto_sq_norms is None:
+            proto_sq_norms = prototypes.pow(2).sum(dim=1)
+        query = features
+    elif metric == 'cosine':
+        query = F.normalize(features, dim=1)
+    else:
+        raise ValueError("Unknown metric {}.".format(metric))
+
+    best_scores = features.new_empty(features.size(0), 0)
+    best_indices = torch.empty(features.size(0), 0, dtype=torch.long, device=features.device)
+    for start in range(0, num_classes, chunk_size):
+        chunk = prototypes[start:start + chunk_size]
+        if metric == 'l2':
+            scores = -sq_l2_distances(query, chunk, proto_sq_norms[start:start + chunk_size])
+        else:
+            scores = query @ F.normalize(chunk, dim=1).t()
+        indices = torch.arange(start, start + len(chunk), device=features.device).expand(features.size(0), -1)
+
+        # 与已有候选合并, 只保留前keep个
+        scores = torch.cat([best_scores, scores], dim=1)
+        indices = torch.cat([best_indices, indices], dim=1)
+        best_scores, order = torch.topk(scores, k=min(keep, scores.size(1)), dim=1)
+        best_indices = indices.gather(1, order)
+
+    if metric == 'l2':
+        # 对候选用逐元素差值重新计算距离, 消除matmul展开式的舍入误差; 距离相同时序号小的在前
+        candidates = prototypes[best_indices]
+        distances = (features.unsqueeze(1) - candidates).pow(2).sum(dim=2).sqrt()
+        best_indices, order = best_indices.sort(dim=1)
+        distances = distances.gather(1, order)
+        distances, order = distances.sort(dim=1, stable=True)
+        best_indices = best_indices.gather(1, order)[:, :k]
+        best_scores = -distances[:, :k]
+    return best_scores, best_indices
+
+
+def multi_proto_scores(features, prototypes, mask=None, metric='l2', chunk_size=256):
+    """
+    每个类别有多个prototypes(如k-means中心)时的类别分数: 取该类别中最近的prototype
+    类别维度分块, 每块一次matmul, 峰值显存为 O(B·chunk_size·K)
+    Args:
+        prototypes: [C, K, D], 不足K个的类别用mask标出无效位置
+        mask: [C, K] bool, True为有效; 缺省时全部有效
+        metric: 'l2' 为 -最小距离; 'inverse' 为 1/最小平方距离; 'cosine' 为最大余弦相似度
+    Returns:
+        [B, C]
+    """
+    num_classes, k_max, dim = prototypes.shape
+    if metric in ('l2', 'inverse'):
+        query = features
+    elif metric == 'cosine':
+        query = F.normalize(features, dim=1)
+    else:
+        raise ValueError("Unknown metric {}.".format(metric))
+
+    scores = []
+    for start in range(0, num_classes, chunk_size):
+        chunk = prototypes[start:start + chunk_size]
+        flat = chunk.reshape(-1, dim)
+        if metric == 'cosine':
+            values = (query @ F.normalize(flat, dim=1).t()).view(len(query), len(chunk), k_max)
+            if mask is not None:
+                values = values.masked_fill(~mask[start:start + chunk_size], float('-inf'))
+            scores.append(values.amax(dim=2))
+            continue
+        values = sq_l2_distances(query, flat).view(len(query), len(chunk), k_max)
+        if mask is not None:
+            values = values.masked_fill(~mask[start:start + chunk_size], float('inf'))
+        values = values.amin(dim=2)
+        scores.append(values.reciprocal() if metric == 'inverse' else -values.sqrt())
+    return torch.cat(scores, dim=1)
+
+
+
+def segment_proto_scores(features, rows, row_classes, num_classes, metric='l2', chunk_size=4096, row_sq_norms=None):
+    """
+    CSR形式(每个类别的prototypes个数不同, 按类别连续存放)的类别分数: 取该类别中最近的prototype
+    行维度分块, 每块一次matmul + 一次scatter_reduce, 峰值显存为 O(B·chunk_size)
+    Args:
+        rows: [N, D], 所有类别的prototypes
+        row_classes: [N] long, 每行所属的类别
+        row_sq_norms: 'l2'/'inverse'时可传入缓存的 ||p||^2 [N]
+    Returns:
+        [B, num_classes], 没有prototype的类别为最差分数
+    """
+    if metric in ('l2', 'inverse'):
+        if row_sq_norms is None:
+            row_sq_norms = rows.pow(2).sum(dim=1)
+        query, reduce, fill = features, 'amin', float('inf')
+    elif metric == 'cosine':
+        query, reduce, fill = F.normalize(features, dim=1), 'amax', float('-inf')
+    else:
+        raise ValueError("Unknown metric {}.".format(metric))
+
+    best = features.new_full((len(features), num_classes), fill)
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        if metric == 'cosine':
+            values = query @ F.normalize(chunk, dim=1).t()
+        else:
+            values = sq_l2_distances(query, chunk, row_sq_norms[start:start + chunk_size])
+        index = row_classes[start:start + len(chunk)].expand(len(features), -1)
+        best.scatter_reduce_(1, index, values, reduce=reduce)
+    if metric == 'cosine':
+        return best
+    return best.reciprocal() if metric == 'inverse' else -best.sqrt()
+
+
+class NCMClassifier(object):
+    """
+    批量NCM分类器, 一次对整个batch的embedding打分并取top-k, 取代各learner逐样本、逐prototype的classify_with_proto
+    Args:
+        metric: 'l2' 分数为 -距离; 'inverse' 分数为 1/平方距离(排名与'l2'相同); 'cosine' 分数为余弦相似度
+        top_num: 每个样本输出的预测个数
+        confidence: 不为None时使用simplecil的置信度规则, top-1分数 > confidence * top-2分数 才输出预测, 否则整行为-1
+        index: 可选的近似检索索引(utils.ann.IVFIndex), 只用于每个类别一个prototype的情况, 其metric须与分类器一致
+    prototypes可以是张量, 也可以是提供 class_scores 的多prototype存储(utils.prototypes.MultiPrototypeBank / ExemplarBank)
+    """
+
+    def __init__(self, metric='l2', top_num=1, confidence=None, chunk_size=1024, index=None):
+        if metric not in ('l2', 'inverse', 'cosine'):
+            raise ValueError("Unknown metric {}.".format(metric))
+        self.metric = metric
+        self.top_num = top_num
+        self.confidence = confidence
+        self.chunk_size = chunk_size
+        self.index = index
+
+    def topk(self, features, prototypes, mask=None, k=None):
+        """
+        Args:
+            features: [B, D]
+            prototypes: [C, D]; 每个类别多个prototypes时为 [C, K, D] (配合mask), 或带 class_scores 的存储
+        Returns:
+            (scores, indices): [B, k], 分数从大到小
+        """
+        k = min(k or self.top_num, len(prototypes))
+        if not torch.is_tensor(prototypes):
+            scores = prototypes.class_scores(features, metric=self.metric)
+            return torch.topk(scores, k=k, dim=1)
+
+        prototypes = prototypes.to(features.device, features.dtype)
+        if prototypes.dim() == 3:
+            mask = None if mask is None else mask.to(features.device)
+            scores = multi_proto_scores(features, prototypes, mask, metric=self.metric,
+                                        chunk_size=max(1, self.chunk_size // prototypes.size(1)))
+            return torch.topk(scores, k=k, dim=1)
+
+        if self.index is not None:
+            scores, indices = self.index.search(features, k=k)
+        else:
+            scores, indices = ncm_topk(features, prototypes, k=k, metric='cosine' if self.metric == 'cosine' else 'l2',
+                                       chunk_size=self.chunk_size)
+        if self.metric == 'inverse':
+            scores = scores.pow(2).reciprocal()
+        return scores, indices
+
+    def predict(self, features, prototypes, mask=None):
+        """
+        Returns:
+            [B, top_num] 的类别序号(LongTensor), 未通过置信度规则的样本整行为-1
+        """
+        if self.confidence is None:
+            return self.topk(features, prototypes, mask)[1]
+        scores, indices = self.topk(features, prototypes, mask, k=max(self.top_num, 2))
+        indices = indices[:, :self.top_num]
+        if scores.size(1) < 2:
+            return indices
+        confident = scores[:, 0] > self.confidence * scores[:, 1]
+        return torch.where(confident.unsqueeze(1), indices, torch.full_like(indices, -1))
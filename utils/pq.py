@@ -0,0 +1,211 @@
+import time
+import torch
+
+from .ann import _kmeans
+from .ncm import sq_l2_distances
+from .prototypes import ExemplarBank
+
+
+class ProductQuantizer(object):
+    """
+    乘积量化: D维向量切成num_subspaces段, 每段用num_centroids(<=256)个中心编码为一个uint8
+    查询时对每段预先计算查询到各中心的平方距离表, 向量距离为各段查表之和(非对称距离ADC, 查询本身不量化)
+    """
+
+    def __init__(self, num_subspaces=16, num_centroids=256, iters=10, seed=0):
+        if num_centroids > 256:
+            raise ValueError("num_centroids must be <= 256 for uint8 codes, got {}.".format(num_centroids))
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.iters = iters
+        self.seed = seed
+        self.codebooks = None
+
+    @property
+    def is_trained(self):
+        return self.codebooks is not None
+
+    def _split(self, x):
+        if x.shape[1] % self.num_subspaces != 0:
+            raise ValueError("Dim {} is not divisible by {} subspaces.".format(x.shape[1], self.num_subspaces))
+        return x.reshape(len(x), self.num_subspaces, -1)
+
+    def train(self, x):
+        """对每一段分别做k-means, codebooks为 [M, K, D/M]"""
+        x = self._split(x.detach().float())
+        num_centroids = min(self.num_centroids, len(x))
+        self.codebooks = torch.stack([_kmeans(x[:, m], num_centroids, iters=self.iters, seed=self.seed + m)
+                                      for m in range(self.num_subspaces)])
+        return self
+
+    def encode(self, x):
+        """[n, D] -> uint8 codes [n, M]"""
+        x = self._split(x.detach().to(self.codebooks.device, self.codebooks.dtype))
+        codes = [sq_l2_distances(x[:, m], self.codebooks[m]).argmin(dim=1) for m in range(self.num_subspaces)]
+        return torch.stack(codes, dim=1).to(torch.uint8)
+
+    def decode(self, codes):
+        """uint8 codes [n, M] -> 重建向量 [n, D]"""
+        parts = [self.codebooks[m][codes[:, m].long()] for m in range(self.num_subspaces)]
+        return torch.cat(parts, dim=1)
+
+    def distance_table(self, query):
+        """查询 [B, D] 到每段每个中心的平方距离 [B, M, K]"""
+        query = self._split(query.to(self.codebooks.device, self.codebooks.dtype))
+        return torch.stack([sq_l2_distances(query[:, m], self.codebooks[m]) for m in range(self.num_subspaces)], dim=1)
+
+    def adc_distances(self, table, codes):
+        """由距离表与codes [n, M] 得到近似平方距离 [B, n]"""
+        num_centroids = table.size(2)
+        index = codes.long() + torch.arange(self.num_subspaces, device=codes.device) * num_centroids
+        flat = table.reshape(len(table), -1)
+        return flat[:, index.reshape(-1)].view(len(table), len(codes), self.num_subspaces).sum(dim=2)
+
+
+class PQExemplarBank(object):
+    """
+    与ExemplarBank接口一致的乘积量化exemplar存储: 每个任务用该任务的embeddings训练一套codebooks, exemplars只保存uint8 codes
+    768维float32的exemplar为3072字节, num_subspaces=16时为16字节(另加每个任务一份codebooks)
+    打分为ADC近似平方距离, 只支持'l2'/'inverse'
+    """
+
+    def __init__(self, device='cpu', num_subspaces=16, num_centroids=256, iters=10, seed=0):
+        self.device = device
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.iters = iters
+        self.seed = seed
+        self.quantizers = []
+        self.task_row_offsets = [0]
+        self.num_classes = 0
+        self.dim = None
+        self._codes = []
+        self._row_classes = []
+
+    def __len__(self):
+        return self.num_classes
+
+    @property
+    def num_tasks(self):
+        return len(self.quantizers)
+
+    @property
+    def num_rows(self):
+        return self.task_row_offsets[-1]
+
+    def add_task(self, embeddings, labels):
+        """
+        用该任务的embeddings训练新的codebooks并编码, 返回其任务序号
+        Args:
+            embeddings: [n, D]
+            labels: [n] 全局类别序号, 须不小于已有的类别数
+        """
+        labels = torch.as_tensor(labels).long()
+        if len(labels) > 0 and int(labels.min()) < self.num_classes:
+            raise ValueError("Class {} already exists in the bank.".format(int(labels.min())))
+        embeddings = embeddings.detach().to(self.device, torch.float32)
+        self.dim = embeddings.shape[1]
+
+        quantizer = ProductQuantizer(self.num_subspaces, self.num_centroids, iters=self.iters,
+                                     seed=self.seed + self.num_tasks).train(embeddings)
+        self.quantizers.append(quantizer)
+        self._codes.append(quantizer.encode(embeddings))
+        self._row_classes.append(labels.to(self.device))
+        self.task_row_offsets.append(self.num_rows + len(labels))
+        self.num_classes = max(self.num_classes, int(labels.max()) + 1 if len(labels) > 0 else 0)
+        return self.num_tasks - 1
+
+    def class_scores(self, features, metric='l2', chunk_size=4096):
+        """features [B, D] 对所有类别的分数 [B, num_classes]: 每个类别取最近exemplar的ADC距离"""
+        if metric not in ('l2', 'inverse'):
+            raise ValueError("PQExemplarBank does not support metric {}.".format(metric))
+        features = features.to(self.device, torch.float32)
+        best = features.new_full((len(features), self.num_classes), float('inf'))
+        for quantizer, codes, row_classes in zip(self.quantizers, self._codes, self._row_classes):
+            table = quantizer.distance_table(features)
+            for start in range(0, len(codes), chunk_size):
+                distances = quantizer.adc_distances(table, codes[start:start + chunk_size])
+                index = row_classes[start:start + chunk_size].expand(len(features), -1)
+                best.scatter_reduce_(1, index, distances, reduce='amin')
+        return best.reciprocal() if metric == 'inverse' else -best.clamp(min=0).sqrt()
+
+    def memory_bytes(self):
+        """codes + codebooks + 行类别占用的字节数"""
+        codes = sum(codes.numel() * codes.element_size() for codes in self._codes)
+        codebooks = sum(q.codebooks.numel() * q.codebooks.element_size() for q in self.quantizers)
+        return codes + codebooks + self.num_rows * 8
+
+    def float32_bytes(self):
+        """同样的exemplars以float32 ExemplarBank存放时占用的字节数"""
+        return self.num_rows * (self.dim or 0) * 4 + self.num_rows * 8
+
+
+def benchmark(embeddings, labels, queries, query_labels, task_size=None, num_subspaces_list=(8, 16, 32, 64), repeats=3):
+    """
+    对比float32 ExemplarBank与PQExemplarBank: 内存、最近邻(top-1)准确率及其差值、每条查询的平均耗时
+    Args:
+        task_size: 每个任务的类别数, 按类别序号切分任务(每个任务一套codebooks); 缺省为单个任务
+    Returns:
+        list of dict: 第一行为float32基线
+    """
+    num_classes = int(labels.max()) + 1
+    task_size = task_size or num_classes
+    device = embeddings.device
+
+    def build(bank):
+        for start in range(0, num_classes, task_size):
+            rows = ((labels >= start) & (labels < start + task_size)).nonzero().squeeze(-1)
+            bank.add_task(embeddings[rows], labels[rows])
+        return bank
+
+    def timed(bank):
+        bank.class_scores(queries)
+        # 等预热的kernel执行完再计时, 避免计入重复测量
+        if queries.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            scores = bank.class_scores(queries)
+        if queries.is_cuda:
+            torch.cuda.synchronize()
+        accuracy = (scores.argmax(dim=1) == query_labels).float().mean().item()
+        return accuracy, (time.perf_counter() - start) / repeats / len(queries) * 1e3
+
+    exact = build(ExemplarBank(device=device))
+    exact_acc, exact_ms = timed(exact)
+    exact_mb = (exact.rows.numel() * 4 + exact.num_rows * 8) / 2 ** 20
+    rows = [{'subspaces': 'float32', 'MB': exact_mb, 'ratio': 1.0, 'acc': exact_acc, 'delta': 0.0, 'ms/query': exact_ms}]
+    for num_subspaces in num_subspaces_list:
+        bank = build(PQExemplarBank(device=device, num_subspaces=num_subspaces))
+        acc, ms = timed(bank)
+        rows.append({'subspaces': num_subspaces, 'MB': bank.memory_bytes() / 2 ** 20,
+                     'ratio': bank.float32_bytes() / bank.memory_bytes(), 'acc': acc, 'delta': acc - exact_acc,
+                     'ms/query': ms})
+    return rows
+
+
+def report(embeddings, labels, queries, query_labels, **kwargs):
+    rows = benchmark(embeddings, labels, queries, query_labels, **kwargs)
+    keys = list(rows[0].keys())
+    print(' | '.join(f'{key:>10}' for key in keys))
+    for row in rows:
+        print(' | '.join(f'{row[key]:>10.4f}' if isinstance(row[key], float) else f'{row[key]:>10}' for key in keys))
+    return rows
+
+
+if __name__ == '__main__':
+    # 在仓库根目录以 python -m utils.pq 运行(模块使用包内相对导入)
+    # 模拟ViT特征: 每个类别若干子簇, exemplars与查询均为子簇中心附近的样本
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch.manual_seed(0)
+    num_classes, per_class, dim = 100, 200, 768
+    centers = torch.randn(num_classes, 4, dim, device=device)
+
+    def sample(n):
+        labels = torch.randint(0, num_classes, (n,), device=device)
+        modes = torch.randint(0, 4, (n,), device=device)
+        return centers[labels, modes] + 0.8 * torch.randn(n, dim, device=device), labels
+
+    embeddings, labels = sample(num_classes * per_class)
+    queries, query_labels = sample(2048)
+    report(embeddings, labels, queries, query_labels, task_size=10)
@@ -0,0 +1,74 @@
+import torch
+import torch.nn.functional as F
+from torch import nn, optim
+
+from .ncm import sq_l2_distances, multi_proto_scores
+
+
+def inverse_distance_probs(features, prototypes, mask=None, temperature=1e-4):
+    """
+    gdproto的分类概率: softmax(1 / 最小平方距离 / temperature), 整个batch一次计算且保留计算图
+    Args:
+        features: [B, D]
+        prototypes: [C, D], 或每个类别多个prototypes时为 [C, K, D] (配合mask, 取最近的prototype)
+    Returns:
+        [B, C]
+    """
+    if prototypes.dim() == 3:
+        scores = multi_proto_scores(features, prototypes, mask, metric='inverse')
+    else:
+        scores = sq_l2_distances(features, prototypes).reciprocal()
+    return F.softmax(scores / temperature, dim=1)
+
+
+class PrototypeRefiner(object):
+    """
+    gdprotocil/gdprotoscil的prototype梯度优化: 目标与原实现相同, 为所有样本的 MSE(softmax(1/d² / T), one_hot(y)) 之和
+    embeddings按batch_size分块前向/反向并累加梯度, 显存只与batch_size有关;
+    每个epoch的样本均分为steps_per_epoch组, 每组累加完做一次optimizer.step(), steps_per_epoch=1 时与原来的全量单步一致
+    """
+
+    def __init__(self, lr, n_epochs, batch_size=1024, steps_per_epoch=1, temperature=1e-4, seed=0, verbose=True):
+        self.lr = lr
+        self.n_epochs = n_epochs
+        self.batch_size = batch_size
+        self.steps_per_epoch = steps_per_epoch
+        self.temperature = temperature
+        self.seed = seed
+        self.verbose = verbose
+
+    def refine(self, prototypes, embeddings, labels, mask=None):
+        """
+        Args:
+            prototypes: 初始prototypes [C, D] 或 [C, K, D]
+            embeddings: [N, D]
+            labels: [N], 任务内的类别序号 0..C-1
+            mask: prototypes为 [C, K, D] 时的有效位置 [C, K]
+        Returns:
+            优化后的prototypes (detach), 形状与输入相同
+        """
+        device = prototypes.device
+        params = nn.Parameter(prototypes.detach().clone())
+        optimizer = optim.SGD([params], lr=self.lr)
+        embeddings = embeddings.to(device)
+        targets = F.one_hot(torch.as_tensor(labels, device=device).long(), num_classes=len(prototypes)).float()
+        generator = torch.Generator().manual_seed(self.seed)
+
+        num_samples = len(embeddings)
+        for epoch in range(self.n_epochs):
+            # 只有一步时样本顺序不影响结果, 不打乱
+            order = torch.randperm(num_samples, generator=generator).to(device) if self.steps_per_epoch > 1 \
+                else torch.arange(num_samples, device=device)
+            total_loss = 0.
+            for group in order.tensor_split(self.steps_per_epoch):
+                optimizer.zero_grad()
+                for batch in group.split(self.batch_size):
+                    probs = inverse_distance_probs(embeddings[batch], params, mask, self.temperature)
+                    loss = F.mse_loss(probs, targets[batch], reduction='none').mean(dim=1).sum()
+                    loss.backward()
+                    total_loss = total_loss + loss.detach()
+                optimizer.step()
+            if self.verbose:
+                print('total_loss:', float(total_loss))
+
+        return params.detach()
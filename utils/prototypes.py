@@ -0,0 +1,342 @@
+import torch
+
+from .ncm import sq_l2_distances, multi_proto_scores, segment_proto_scores
+
+
+class PrototypeAccumulator(object):
+    """
+    流式的按类别prototype累加器, 只保存每个类别的embedding和与样本数, 内存为O(C·D)而不是O(N·D)
+    每个batch用一次index_add_完成累加; 同一类别的新样本可以随时继续update, 多个累加器(如多个loader/进程)可以merge
+    """
+
+    def __init__(self, num_classes=0, dim=None, device='cpu', dtype=torch.float64):
+        self.dim = dim
+        self.device = device
+        self.dtype = dtype
+        self.sums = None
+        self.counts = None
+        if dim is not None:
+            self._allocate(num_classes, dim)
+
+    def _allocate(self, num_classes, dim):
+        self.dim = dim
+        self.sums = torch.zeros(num_classes, dim, device=self.device, dtype=self.dtype)
+        self.counts = torch.zeros(num_classes, device=self.device, dtype=torch.long)
+
+    @property
+    def num_classes(self):
+        return 0 if self.counts is None else len(self.counts)
+
+    def _grow(self, num_classes):
+        # 容量按倍数增长, 类别数逐任务增加时摊还O(1)
+        if num_classes <= self.num_classes:
+            return
+        capacity = max(num_classes, 2 * self.num_classes)
+        sums = torch.zeros(capacity, self.dim, device=self.device, dtype=self.dtype)
+        counts = torch.zeros(capacity, device=self.device, dtype=torch.long)
+        sums[:self.num_classes] = self.sums
+        counts[:self.num_classes] = self.counts
+        self.sums, self.counts = sums, counts
+
+    def update(self, embeddings, labels):
+        """累加一个batch: embeddings [B, D], labels [B] (全局类别序号)"""
+        if self.sums is None:
+            self._allocate(0, embeddings.shape[1])
+        labels = labels.to(self.device).long()
+        self._grow(int(labels.max()) + 1)
+        self.sums.index_add_(0, labels, embeddings.detach().to(self.device, self.dtype))
+        self.counts.index_add_(0, labels, torch.ones_like(labels))
+        return self
+
+    def merge(self, other):
+        """合并另一个累加器的结果(类别序号相同的部分相加)"""
+        if other.sums is None:
+            return self
+        if self.sums is None:
+            self._allocate(0, other.dim)
+        self._grow(other.num_classes)
+        self.sums[:other.num_classes] += other.sums.to(self.device, self.dtype)
+        self.counts[:other.num_classes] += other.counts.to(self.device)
+        return self
+
+    def classes(self):
+        """出现过的类别序号, 从小到大"""
+        if self.counts is None:
+            return torch.zeros(0, dtype=torch.long, device=self.device)
+        return (self.counts > 0).nonzero().squeeze(-1)
+
+    def protos(self, classes=None):
+        """
+        返回各类别的mean prototypes [len(classes), D] (float32)
+        Args:
+            classes: 需要的类别序号, 缺省为所有出现过的类别
+        """
+        classes = self.classes() if classes is None else torch.as_tensor(classes, device=self.device).long()
+        means = self.sums[classes] / self.counts[classes].clamp(min=1).unsqueeze(1).to(self.dtype)
+        return means.float()
+
+    def proto_list(self, classes=None):
+        """与 feature_proto_list 一致的形式: 每个类别一个 [D] 的CPU张量"""
+        return list(self.protos(classes).cpu().unbind(0))
+
+
+def pad_prototypes(proto_sets):
+    """
+    把每个类别若干个prototypes(list of list of [D] 或 list of [n_c, D])补齐为一个张量
+    Returns:
+        (padded, mask): [C, K_max, D] 与 [C, K_max] bool, mask为True的位置有效
+    """
+    proto_sets = [torch.stack(list(protos)) if isinstance(protos, (list, tuple)) else protos for protos in proto_sets]
+    counts = torch.tensor([len(protos) for protos in proto_sets])
+    padded = torch.nn.utils.rnn.pad_sequence([protos.detach() for protos in proto_sets], batch_first=True)
+    mask = torch.arange(padded.size(1)).unsqueeze(0) < counts.unsqueeze(1)
+    return padded, mask
+
+
+class PrototypeBank(object):
+    """
+    所有类别的prototypes连续存放在一块预分配的设备张量 [capacity, D] 中, 并记录每个任务的类别区间(与classes_per_task对应)
+    新任务追加时容量倍增(摊还O(1)); 训练中某个任务的prototypes原地替换, 不再每次 list相加 + torch.stack + .to(device)
+    prototypes的平方范数会被缓存, 供 ||x||^2 - 2x·p + ||p||^2 形式的距离计算复用, 内容改变时自动失效
+    """
+
+    def __init__(self, device='cpu', dim=None, capacity=0, dtype=torch.float32):
+        self.device = device
+        self.dim = dim
+        self.dtype = dtype
+        self.num_classes = 0
+        self.task_offsets = [0]
+        self._data = None if dim is None else torch.zeros(capacity, dim, device=device, dtype=dtype)
+        self._sq_norms = None
+
+    def __len__(self):
+        return self.num_classes
+
+    @property
+    def num_tasks(self):
+        return len(self.task_offsets) - 1
+
+    @property
+    def prototypes(self):
+        """所有类别的prototypes [num_classes, D], 为底层张量的视图(不拷贝)"""
+        if self._data is None:
+            return torch.zeros(0, self.dim or 0, device=self.device, dtype=self.dtype)
+        return self._data[:self.num_classes]
+
+    @property
+    def sq_norms(self):
+        """缓存的 ||p||^2 [num_classes]"""
+        if self._sq_norms is None:
+            self._sq_norms = self.prototypes.pow(2).sum(dim=1)
+        return self._sq_norms
+
+    def task_range(self, task_id):
+        if not 0 <= task_id < self.num_tasks:
+            raise ValueError("Unknown task {}.".format(task_id))
+        return self.task_offsets[task_id], self.task_offsets[task_id + 1]
+
+    def task(self, task_id):
+        """第task_id个任务的prototypes视图"""
+        start, end = self.task_range(task_id)
+        return self._data[start:end]
+
+    def previous(self, task_id):
+        """task_id之前所有任务(旧类别)的prototypes视图"""
+        return self.prototypes[:self.task_offsets[min(task_id, self.num_tasks)]]
+
+    def _as_tensor(self, protos):
+        if isinstance(protos, (list, tuple)):
+            protos = torch.stack(list(protos))
+        return protos.detach().to(self.device, self.dtype)
+
+    def _reserve(self, num_classes, dim):
+        if self._data is None:
+            self.dim = dim
+            self._data = torch.zeros(num_classes, dim, device=self.device, dtype=self.dtype)
+        elif num_classes > len(self._data):
+            data = torch.zeros(max(num_classes, 2 * len(self._data)), self.dim, device=self.device, dtype=self.dtype)
+            data[:self.num_classes] = self._data[:self.num_classes]
+            self._data = data
+
+    def add_task(self, protos):
+        """追加一个新任务的prototypes (list of [D] 或 [C, D]), 返回其任务序号"""
+        protos = self._as_tensor(protos)
+        self._reserve(self.num_classes + len(protos), protos.shape[1])
+        self._data[self.num_classes:self.num_classes + len(protos)] = protos
+        self.num_classes += len(protos)
+        self.task_offsets.append(self.num_classes)
+        self._sq_norms = None
+        return self.num_tasks - 1
+
+    def set_task(self, task_id, protos):
+        """原地替换某个任务的prototypes, 类别数须与该任务一致"""
+        start, end = self.task_range(task_id)
+        protos = self._as_tensor(protos)
+        if len(protos) != end - start:
+            raise ValueError("Task {} has {} classes, got {} prototypes.".format(task_id, end - start, len(protos)))
+        self.replace(start, protos)
+
+    def replace(self, start, protos):
+        """原地替换从start开始的连续若干行(如prototypes漂移后的旧类别)"""
+        protos = self._as_tensor(protos)
+        if start < 0 or start + len(protos) > self.num_classes:
+            raise ValueError("Rows [{}, {}) out of range.".format(start, start + len(protos)))
+        self._data[start:start + len(protos)] = protos
+        self._sq_norms = None
+
+    def sq_distances(self, features):
+        """features [B, D] 到所有prototypes的平方L2距离 [B, num_classes], 复用缓存的 ||p||^2"""
+        return sq_l2_distances(features.to(self.dtype), self.prototypes, self.sq_norms)
+
+
+class MultiPrototypeBank(object):
+    """
+    每个类别若干个prototypes(如k-means中心)存放在一块 [capacity, K_max, D] 的设备张量中, mask [capacity, K_max] 标出有效位置
+    新任务追加时类别容量倍增, K_max不足时沿K维补齐; 评估时直接对整块张量打分, 不再逐类别 torch.stack
+    """
+
+    def __init__(self, device='cpu', dtype=torch.float32):
+        self.device = device
+        self.dtype = dtype
+        self.num_classes = 0
+        self.task_offsets = [0]
+        self._data = None
+        self._mask = None
+
+    def __len__(self):
+        return self.num_classes
+
+    @property
+    def num_tasks(self):
+        return len(self.task_offsets) - 1
+
+    @property
+    def prototypes(self):
+        """[num_classes, K_max, D] 视图"""
+        return self._data[:self.num_classes]
+
+    @property
+    def mask(self):
+        """[num_classes, K_max] bool 视图"""
+        return self._mask[:self.num_classes]
+
+    def _reserve(self, num_classes, k_max, dim):
+        if self._data is None:
+            self._data = torch.zeros(num_classes, k_max, dim, device=self.device, dtype=self.dtype)
+            self._mask = torch.zeros(num_classes, k_max, device=self.device, dtype=torch.bool)
+            return
+        capacity = max(num_classes, 2 * len(self._data)) if num_classes > len(self._data) else len(self._data)
+        k_max = max(k_max, self._data.size(1))
+        if capacity == len(self._data) and k_max == self._data.size(1):
+            return
+        data = torch.zeros(capacity, k_max, dim, device=self.device, dtype=self.dtype)
+        mask = torch.zeros(capacity, k_max, device=self.device, dtype=torch.bool)
+        data[:self.num_classes, :self._data.size(1)] = self.prototypes
+        mask[:self.num_classes, :self._mask.size(1)] = self.mask
+        self._data, self._mask = data, mask
+
+    def add_task(self, proto_sets):
+        """追加一个新任务: 每个类别一组prototypes (list of list of [D] 或 list of [n_c, D]), 返回其任务序号"""
+        padded, mask = pad_prototypes(proto_sets)
+        num_new, k_max, dim = padded.shape
+        self._reserve(self.num_classes + num_new, k_max, dim)
+        self._data[self.num_classes:self.num_classes + num_new, :k_max] = padded.to(self.device, self.dtype)
+        self._mask[self.num_classes:self.num_classes + num_new, :k_max] = mask.to(self.device)
+        self.num_classes += num_new
+        self.task_offsets.append(self.num_classes)
+        return self.num_tasks - 1
+
+    def class_scores(self, features, metric='l2', chunk_size=256):
+        """features [B, D] 对所有类别的分数 [B, num_classes], 见 ncm.multi_proto_scores"""
+        return multi_proto_scores(features.to(self.device, self.dtype), self.prototypes, self.mask,
+                                  metric=metric, chunk_size=chunk_size)
+
+
+class ExemplarBank(object):
+    """
+    每个类别个数不一的exemplar embeddings以CSR形式存放: rows [N, D] 按类别连续, offsets [num_classes + 1]
+    类别c的exemplars为 rows[offsets[c]:offsets[c + 1]]; 适用于各类别样本数相差较大、不宜补齐成 [C, K_max, D] 的情况
+    """
+
+    def __init__(self, device='cpu', dtype=torch.float32):
+        self.device = device
+        self.dtype = dtype
+        self.num_rows = 0
+        self.offsets = torch.zeros(1, dtype=torch.long)
+        self.task_offsets = [0]
+        self._rows = None
+        self._row_classes = None
+        self._sq_norms = None
+
+    def __len__(self):
+        return self.num_classes
+
+    @property
+    def num_classes(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_tasks(self):
+        return len(self.task_offsets) - 1
+
+    @property
+    def rows(self):
+        """[N, D] 视图"""
+        return self._rows[:self.num_rows]
+
+    @property
+    def row_classes(self):
+        return self._row_classes[:self.num_rows]
+
+    @property
+    def sq_norms(self):
+        if self._sq_norms is None:
+            self._sq_norms = self.rows.pow(2).sum(dim=1)
+        return self._sq_norms
+
+    def class_rows(self, class_index):
+        return self._rows[int(self.offsets[class_index]):int(self.offsets[class_index + 1])]
+
+    def _reserve(self, num_rows, dim):
+        if self._rows is None:
+            self._rows = torch.zeros(num_rows, dim, device=self.device, dtype=self.dtype)
+            self._row_classes = torch.zeros(num_rows, device=self.device, dtype=torch.long)
+        elif num_rows > len(self._rows):
+            capacity = max(num_rows, 2 * len(self._rows))
+            rows = torch.zeros(capacity, dim, device=self.device, dtype=self.dtype)
+            row_classes = torch.zeros(capacity, device=self.device, dtype=torch.long)
+            rows[:self.num_rows] = self.rows
+            row_classes[:self.num_rows] = self.row_classes
+            self._rows, self._row_classes = rows, row_classes
+
+    def add_task(self, embeddings, labels):
+        """
+        追加一个新任务的exemplars, 返回其任务序号
+        Args:
+            embeddings: [n, D]
+            labels: [n] 全局类别序号, 须不小于已有的类别数(新任务的类别); 中间缺失的类别视为空
+        """
+        labels = torch.as_tensor(labels).long().cpu()
+        if len(labels) > 0 and int(labels.min()) < self.num_classes:
+            raise ValueError("Class {} already exists in the bank.".format(int(labels.min())))
+        order = torch.argsort(labels, stable=True)
+        embeddings = embeddings.detach()[order.to(embeddings.device)]
+        labels = labels[order]
+
+        self._reserve(self.num_rows + len(labels), embeddings.shape[1])
+        self._rows[self.num_rows:self.num_rows + len(labels)] = embeddings.to(self.device, self.dtype)
+        self._row_classes[self.num_rows:self.num_rows + len(labels)] = labels.to(self.device)
+        self.num_rows += len(labels)
+        self._sq_norms = None
+
+        num_classes = int(labels.max()) + 1 if len(labels) > 0 else self.num_classes
+        counts = torch.bincount(labels, minlength=num_classes)[self.num_classes:]
+        self.offsets = torch.cat([self.offsets, self.offsets[-1] + counts.cumsum(0)])
+        self.task_offsets.append(self.num_classes)
+        return self.num_tasks - 1
+
+    def class_scores(self, features, metric='l2', chunk_size=4096):
+        """features [B, D] 对所有类别的分数 [B, num_classes], 见 ncm.segment_proto_scores"""
+        sq_norms = None if metric == 'cosine' else self.sq_norms
+        return segment_proto_scores(features.to(self.device, self.dtype), self.rows, self.row_classes, self.num_classes,
+                                    metric=metric, chunk_size=chunk_size, row_sq_norms=sq_norms)
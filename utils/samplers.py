@@ -0,0 +1,61 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class RepeatSampler(Sampler):
+    """
+    虚拟重复的随机采样器: 每一轮产出把 [0, num_samples) 重复repeats次后的随机排列,
+    等价于对repeats份相同数据集的ConcatDataset做shuffle, 但只需一个数据集对象
+    infinite=True时一轮接一轮无限产出, 配合 InfiniteLoader 只创建一次DataLoader迭代器
+    """
+
+    def __init__(self, num_samples, repeats=1, shuffle=True, infinite=False, seed=0):
+        self.num_samples = num_samples
+        self.repeats = repeats
+        self.shuffle = shuffle
+        self.infinite = infinite
+        self.seed = seed
+
+    def __len__(self):
+        return self.num_samples * self.repeats
+
+    def _one_pass(self, generator):
+        indices = torch.arange(self.num_samples).repeat(self.repeats)
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), generator=generator)]
+        return indices.tolist()
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + int(torch.randint(2 ** 31, ())))
+        while True:
+            yield from self._one_pass(generator)
+            if not self.infinite:
+                return
+
+
+class InfiniteLoader(object):
+    """
+    长生命周期的辅助batch流: 对使用无限采样器的loader只调用一次iter(), 之后每次next()取一个batch,
+    避免每个训练step重新创建迭代器(重新打乱全部下标、重启worker)
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._iterator = None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = iter(self.loader)
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            # 有限采样器时循环加载
+            self._iterator = iter(self.loader)
+            return next(self._iterator)
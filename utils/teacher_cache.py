@@ -0,0 +1,51 @@
+import torch
+from tqdm import tqdm
+
+
+class TeacherCache(object):
+    """
+    旧prompt/adapter(teacher)在当前任务训练集上的输出缓存
+    train_loader_for_protonet使用确定性的测试transforms, 任务内旧teacher的输出不会变化:
+    每个任务开始训练前对每个旧prompt前向一次整个loader, 结果 [n_teachers, N, D] 按数据集下标存放,
+    训练时按batch的下标直接取出, 不再每一步对每个旧prompt重新做ViT前向
+    """
+
+    def __init__(self, device='cpu', dtype=torch.float32):
+        self.device = device
+        self.dtype = dtype
+        self.outputs = None
+
+    def __len__(self):
+        return 0 if self.outputs is None else len(self.outputs)
+
+    def build(self, data_loader, model, teachers, load_teacher):
+        """
+        Args:
+            data_loader: 产出 (idx, inputs, targets), idx为数据集下标
+            model: 旧网络, 每个teacher通过load_teacher(model, teacher)载入
+            teachers: prompt_pool / adapter_pool
+        """
+        self.outputs = None
+        if len(teachers) == 0:
+            return self
+        num_samples = len(data_loader.dataset)
+        was_training = model.training
+        model.eval()
+        with torch.no_grad():
+            for teacher_id, teacher in enumerate(teachers):
+                load_teacher(model, teacher)
+                model.to(self.device)
+                for idx, inputs, _ in tqdm(data_loader, desc=f"Teacher {teacher_id}", ncols=120):
+                    outputs = model(inputs.to(self.device))
+                    if self.outputs is None:
+                        self.outputs = torch.zeros(len(teachers), num_samples, outputs.shape[1],
+                                                   device=self.device, dtype=self.dtype)
+                    self.outputs[teacher_id, idx.to(self.device)] = outputs.to(self.dtype)
+        model.train(was_training)
+        return self
+
+    def get(self, idx):
+        """batch下标 [B] -> 每个teacher的输出 [n_teachers, B, D] (float32); 没有teacher时为None"""
+        if self.outputs is None:
+            return None
+        return self.outputs[:, idx.to(self.device)].float()
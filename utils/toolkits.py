@@ -2,17 +2,23 @@ import torch
 import torchvision
 import torchvision.transforms as transforms
 import numpy as np
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, ConcatDataset
 from PIL import Image
 import matplotlib.pyplot as plt
 import torch.nn.functional as F
 import json
 import argparse
+import random
 from tqdm import tqdm
 from sklearn.manifold import TSNE
 import os
 
 from . import data_category
+from .batch_augment import BatchTransformLoader
+from .embedding_cache import model_fingerprint
+from .prototypes import PrototypeAccumulator
+from .ncm import ncm_topk
+from .metrics import AccuracyMeter
 from convs.adapter import Adapter, VisionTransformer
 
 
@@ -25,6 +31,49 @@ def seed_set(seed=1):
     np.random.seed(1993)
 
 
+def seed_worker(worker_id):
+    # DataLoader为每个worker设置的torch种子来自全局RNG(已由seed_set固定), 据此同步numpy与random,
+    # 避免fork出的worker共享同一numpy/random状态, 同时保持可复现
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
+def build_dataloader(dataset, args, batch_size, shuffle=False, **kwargs):
+    """
+    统一的DataLoader构建入口, 多进程相关参数由实验配置json给出:
+        num_workers (默认0), persistent_workers (默认False), prefetch_factor (默认2), pin_memory (默认False)
+    exps下的配置均保持上述默认值(单进程加载); 需要多进程加载时在实验json中改为如
+        "num_workers": 4, "persistent_workers": true, "pin_memory": true
+    配置 batch_augment 为true时, 返回的loader产出已在设备上完成增强的batch
+    """
+    num_workers = args.get("num_workers", 0)
+    loader_kwargs = dict(batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                         pin_memory=args.get("pin_memory", False) and torch.cuda.is_available())
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=args.get("persistent_workers", False),
+                             prefetch_factor=args.get("prefetch_factor", 2),
+                             worker_init_fn=seed_worker)
+    loader_kwargs.update(kwargs)
+    loader = DataLoader(dataset, **loader_kwargs)
+
+    # 批量增强模式下数据集带有batch_trsf, 增强在计算设备上按batch执行
+    batch_trsf = getattr(dataset, 'batch_trsf', None)
+    if batch_trsf is None and isinstance(dataset, ConcatDataset):
+        batch_trsf = getattr(dataset.datasets[0], 'batch_trsf', None)
+    if batch_trsf is not None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        loader = BatchTransformLoader(loader, batch_trsf, device)
+    return loader
+
+
+def share_array(array):
+    # 将numpy数组放入共享内存, fork出的DataLoader worker直接映射而不拷贝
+    shared = torch.empty(array.shape, dtype=torch.from_numpy(array[:0]).dtype).share_memory_()
+    shared.numpy()[...] = array
+    return shared.numpy()
+
+
 # 加载数据集
 def get_idata(dataset_name, args=None):
     dataset_name = dataset_name.lower()
@@ -57,6 +106,51 @@ def get_increments_list(init_cls, increment, _class_order):
     return _increments
 
 
+def build_class_index(targets, num_classes=None):
+    """
+    构建CSR形式的 class -> 样本下标 索引
+    Args:
+        targets: 原始标签数组 [N]
+        num_classes: 类别总数, 缺省为 targets.max() + 1
+    Returns:
+        order: 按类别稳定排序后的样本下标 [N], data[order] 即为按类别连续存放的数据
+        offsets: [num_classes + 1], 类别c在排序后数组中的区间为 offsets[c]:offsets[c + 1]
+    """
+    targets = np.asarray(targets, dtype=np.int64)
+    if num_classes is None:
+        num_classes = int(targets.max()) + 1 if len(targets) > 0 else 0
+    order = np.argsort(targets, kind='stable')  # stable保证类内顺序与原数据一致
+    counts = np.bincount(targets, minlength=num_classes)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return order, offsets
+
+
+def gather_class_rows(offsets, indices):
+    """
+    根据CSR索引取出若干类别的全部行下标(按indices顺序拼接), 纯向量化无逐类np.where
+    Args:
+        offsets: build_class_index 返回的 offsets
+        indices: 需要的类别列表
+    Returns:
+        rows: 行下标 [M], int64
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    num_classes = len(offsets) - 1
+    indices = indices[(indices >= 0) & (indices < num_classes)]  # 越界类别与原实现一致, 视为空
+    starts, ends = offsets[indices], offsets[indices + 1]
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # 连续类别区间直接用arange, 否则对每段做 start + 段内偏移
+    if len(indices) == 1 or np.all(starts[1:] == ends[:-1]):
+        return np.arange(starts[0], starts[0] + total, dtype=np.int64)
+    seg_begin = np.cumsum(lengths) - lengths
+    return np.repeat(starts - seg_begin, lengths) + np.arange(total, dtype=np.int64)
+
+
 def get_model(model_name, args):
     name = model_name.lower()
     if name == 'simplecil':
@@ -179,85 +273,180 @@ def top_k_accuracy(y_pred, y_true, k):
     return accuracy
 
 
-def get_protos_with_tqdm(data_loader, device, model):
+def iter_embeddings(data_loader, device, model, forward=None, cache=None, backbone_id=None):
+    """
+    逐batch产出 (sample_ids, embeddings, targets), 需在torch.no_grad()下调用
+    Args:
+        forward: 提取特征的函数, 缺省为model本身(如可传入model.forward_features_)
+        cache: EmbeddingCache, 数据集为确定性模式(test/flip)时命中的样本直接查表, 全部命中时不再读取图片
+        backbone_id: 冻结backbone的标识(如预训练模型名), 与prompt/adapter哈希共同组成缓存键
+    """
+    forward = forward if forward is not None else model
+    dataset = data_loader.dataset
+    sample_ids_all = getattr(dataset, 'sample_ids', None)
+
+    table = None
+    if cache is not None and sample_ids_all is not None:
+        dim = getattr(model, 'num_features', None) or getattr(model, 'out_dim', None)
+        model_key = model_fingerprint(model, backbone_id, getattr(forward, '__name__', 'forward'))
+        table = cache.table(model_key, dataset, dim)
+
+    # 全部命中: 按数据集顺序直接从缓存分batch读取
+    if table is not None and table.hit(sample_ids_all).all():
+        batch_size = data_loader.batch_size
+        for start in range(0, len(dataset), batch_size):
+            sample_ids = sample_ids_all[start:start + batch_size]
+            yield (torch.as_tensor(sample_ids), table.get(sample_ids).to(device),
+                   torch.as_tensor(dataset.labels[start:start + batch_size]))
+        return
+
+    for idx, inputs, targets in data_loader:
+        sample_ids = idx if sample_ids_all is None else torch.as_tensor(sample_ids_all[idx.numpy()])
+        if table is None:
+            yield sample_ids, forward(inputs.to(device)), targets
+            continue
+
+        # 部分命中: 只对未命中的样本做前向, 并写回缓存
+        hit = table.hit(sample_ids.numpy())
+        embedding = torch.empty(len(idx), table.dim, device=device)
+        if hit.any():
+            embedding[torch.from_numpy(hit).to(device)] = table.get(sample_ids.numpy()[hit]).to(device)
+        if not hit.all():
+            miss = ~hit
+            outputs = forward(inputs[torch.from_numpy(miss).to(inputs.device)].to(device))
+            table.put(sample_ids.numpy()[miss], outputs)
+            embedding[torch.from_numpy(miss).to(device)] = outputs.float()
+        yield sample_ids, embedding, targets
+
+
+def extract_embeddings(data_loader, device, model, forward=None, cache=None, backbone_id=None, desc="Inference"):
+    """提取整个loader的embedding, 返回CPU上的 (embeddings [N, D], labels [N])"""
     model.to(device)
     embedding_list = []
     label_list = []
     with torch.no_grad():
-        for _, inputs, targets in tqdm(data_loader, desc="Inference", ncols=120):
-            inputs = inputs.to(device)
-            embedding = model(inputs)
+        for _, embedding, targets in tqdm(iter_embeddings(data_loader, device, model, forward, cache, backbone_id),
+                                          total=len(data_loader), desc=desc, ncols=120):
             embedding_list.append(embedding.cpu())
             label_list.append(targets.cpu())
     embedding_list = torch.cat(embedding_list, dim=0)
     label_list = torch.cat(label_list, dim=0)
+    return embedding_list, label_list
 
-    # NCM, 对class’s features取mean
-    class_list = np.unique(label_list)
-    feature_proto_list = []
-    for class_index in class_list:
-        data_index = (label_list == class_index).nonzero().squeeze(-1)
-        embeddings = embedding_list[data_index]
-        proto = embeddings.mean(0)
-        feature_proto_list.append(proto)
 
-    return feature_proto_list
+def get_protos_with_tqdm(data_loader, device, model, forward=None, cache=None, backbone_id=None, desc="Inference"):
+    # NCM, 对class’s features取mean; 流式累加, 不保存全部embedding
+    accumulator = PrototypeAccumulator(device=device)
+    model.to(device)
+    with torch.no_grad():
+        for _, embedding, targets in tqdm(iter_embeddings(data_loader, device, model, forward, cache, backbone_id),
+                                          total=len(data_loader), desc=desc, ncols=120):
+            accumulator.update(embedding, targets)
+
+    return accumulator.proto_list()
 
 
 def get_protos(data_loader, device, model):
-    embedding_list = []
-    label_list = []
+    accumulator = PrototypeAccumulator(device=device)
     with torch.no_grad():
         for inputs, targets in data_loader:
             inputs = inputs.to(device)
             embedding = model.forward_features_(inputs)
-            embedding_list.append(embedding.cpu())
-            label_list.append(targets.cpu())
-    embedding_list = torch.cat(embedding_list, dim=0)
-    label_list = torch.cat(label_list, dim=0)
+            accumulator.update(embedding, targets)
 
     # NCM, 对class’s features取mean
-    class_list = np.unique(label_list)
-    feature_proto_list = []
-    for class_index in class_list:
-        data_index = (label_list == class_index).nonzero().squeeze(-1)
-        embeddings = embedding_list[data_index]
-        proto = embeddings.mean(0)
-        feature_proto_list.append(proto)
+    return accumulator.proto_list()
 
-    return feature_proto_list
 
-
-def test_accuracy(model, data_loader, prototypes, epoch=-1, num_epochs=0, device='cuda', words='Test', top_num=2):
+def test_accuracy(model, data_loader, prototypes, epoch=-1, num_epochs=0, device='cuda', words='Test', top_num=2,
+                  cache=None, backbone_id=None, index=None, report_every=10, meter=None):
+    """
+    Args:
+        meter: 可传入AccuracyMeter(如keep_predictions=True以保留逐样本预测), 缺省时新建
+    Returns:
+        top-1准确率(%)
+    """
     model.eval()
+    # 准确率与混淆矩阵在设备上流式累计, 每report_every个batch才同步一次刷新进度条
+    if meter is None:
+        meter = AccuracyMeter(num_classes=len(prototypes), top_ks=sorted({1, top_num}), device=device,
+                              report_every=report_every)
     with tqdm(total=len(data_loader), desc=f"{words} Epoch [{epoch + 1}/{num_epochs}]",
               ncols=120) as pbar_test:
-        y_pred, y_true = [], []
         with torch.no_grad():  # 不计算梯度
-            for _, inputs, targets in data_loader:
-                inputs, targets = inputs.to(device), targets.to(device)
-                outputs = model(inputs)
-
-                # 批量计算与所有原型的L2距离（高效向量化）
-                temperature = 1.0
-                distances = torch.cdist(outputs, prototypes, p=2)
-                logits = -distances / temperature
-
-                # 取Top-K预测结果
-                _, top_indices = torch.topk(logits, k=top_num, dim=1)
-                batch_preds = top_indices.cpu().tolist()  # 取Top1预测
-
-                y_pred.extend(batch_preds)
-                y_true.extend(targets.cpu().tolist())
+            proto_sq_norms = prototypes.pow(2).sum(dim=1)
+            for _, outputs, targets in iter_embeddings(data_loader, device, model, cache=cache, backbone_id=backbone_id):
+                # 按类别分块计算L2距离并合并Top-K, 排名与 topk(-cdist) 一致; 给定ANN索引(需与prototypes同步)时近似检索
+                if index is not None:
+                    _, top_indices = index.search(outputs, k=top_num)
+                else:
+                    _, top_indices = ncm_topk(outputs, prototypes, k=top_num, proto_sq_norms=proto_sq_norms)
+                meter.update(top_indices, targets, num_classes=len(prototypes))
 
                 # 更新测试进度条信息
-                test_accuracy = 100 * top_k_accuracy(y_pred=y_pred, y_true=y_true, k=1)
-                pbar_test.set_postfix(accuracy=f"{test_accuracy:.2f}%")
+                if meter.should_report():
+                    pbar_test.set_postfix(accuracy=f"{meter.accuracy():.2f}%")
                 pbar_test.update(1)
+        test_accuracy = meter.accuracy()
+        pbar_test.set_postfix(accuracy=f"{test_accuracy:.2f}%")
 
     return test_accuracy
 
 
+def get_protos_and_accuracy(data_loader, device, model, previous_protos=None, epoch=-1, num_epochs=0, words='Train',
+                            top_num=2, cache=None, backbone_id=None):
+    """
+    一次前向同时得到当前任务的prototypes和该loader上的NCM准确率
+    代替对同一loader先 get_protos_with_tqdm 再 test_accuracy 的两遍推理
+    Args:
+        previous_protos: 旧类别的prototypes(列表或[C, D]张量), 准确率针对 previous_protos + 新prototypes 计算(与test_accuracy一致)
+    Returns:
+        (feature_proto_list, accuracy): 当前loader中各类别的prototypes列表, 以及top-1准确率(%)
+    """
+    model.eval()
+    model.to(device)
+    old_protos = None
+    if previous_protos is not None and len(previous_protos) > 0:
+        old_protos = previous_protos if torch.is_tensor(previous_protos) else torch.stack(list(previous_protos))
+        old_protos = old_protos.to(device)
+        old_sq_norms = old_protos.pow(2).sum(dim=1)
+
+    # 每个batch累加进prototypes, 同时对旧prototypes取top-k; 新prototypes要等整个loader结束才确定,
+    # 因此各batch的embedding(fp32, CPU)会一直保留到新prototypes算出为止, 只是不再保存 N×C 的距离
+    accumulator = PrototypeAccumulator(device=device)
+    chunks = []
+    with torch.no_grad():
+        for _, embedding, targets in tqdm(iter_embeddings(data_loader, device, model, cache=cache, backbone_id=backbone_id),
+                                          total=len(data_loader), desc=f"{words} Epoch [{epoch + 1}/{num_epochs}]", ncols=120):
+            accumulator.update(embedding, targets)
+            old_top = ncm_topk(embedding, old_protos, k=top_num, proto_sq_norms=old_sq_norms) \
+                if old_protos is not None else None
+            chunks.append((old_top, embedding.cpu(), targets))
+    feature_proto_list = accumulator.proto_list()
+
+    # 用新prototypes逐batch打分([B, C_new]), 与旧prototypes上的top-k合并
+    new_protos = torch.stack(feature_proto_list).to(device)
+    num_old = 0 if old_protos is None else len(old_protos)
+    num_classes = num_old + len(new_protos)
+    meter = AccuracyMeter(num_classes=num_classes, device=device)
+    with torch.no_grad():
+        new_sq_norms = new_protos.pow(2).sum(dim=1)
+        for old_top, embedding, targets in chunks:
+            scores, top_indices = ncm_topk(embedding.to(device, new_protos.dtype), new_protos, k=top_num,
+                                           proto_sq_norms=new_sq_norms)
+            top_indices = top_indices + num_old
+            if old_top is not None:
+                scores = torch.cat([old_top[0].to(scores.dtype), scores], dim=1)
+                top_indices = torch.cat([old_top[1], top_indices], dim=1)
+                scores, order = scores.topk(min(top_num, num_classes), dim=1)
+                top_indices = top_indices.gather(1, order)
+            meter.update(top_indices, targets, num_classes=num_classes)
+
+    accuracy = meter.accuracy()
+    print(f"{words} Epoch [{epoch + 1}/{num_epochs}]: accuracy={accuracy:.2f}%")
+    return feature_proto_list, accuracy
+
+
 def tsne_classes(feature_bank, target_bank):
     # 假设 feature_bank 和 target_bank 已经转换为 NumPy 数组
     feature_bank = feature_bank.numpy()
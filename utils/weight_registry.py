@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import struct
+import argparse
+from collections import OrderedDict
+import numpy as np
+import torch
+
+# 本地权重目录, 可由环境变量 WEIGHT_DIR 或实验配置中的 weight_dir 覆盖
+DEFAULT_ROOT = os.environ.get('WEIGHT_DIR', './weights')
+ALIGNMENT = 64
+
+DTYPES = {torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16', torch.float64: 'F64',
+          torch.int64: 'I64', torch.int32: 'I32', torch.uint8: 'U8', torch.bool: 'BOOL'}
+TORCH_DTYPES = {name: dtype for dtype, name in DTYPES.items()}
+
+
+def save_weights(state_dict, path):
+    """
+    以safetensors格式写入state_dict: 8字节小端header长度 + JSON header + 原始数据
+    每个张量的起始位置按ALIGNMENT字节对齐, 读取时可以直接在memmap上按dtype view; 先写临时文件再rename
+    """
+    header, offset = OrderedDict(), 0
+    tensors = OrderedDict((name, tensor.detach().cpu().contiguous()) for name, tensor in state_dict.items())
+    for name, tensor in tensors.items():
+        offset += -offset % ALIGNMENT
+        nbytes = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': DTYPES[tensor.dtype], 'shape': list(tensor.shape), 'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * (-(8 + len(header_bytes)) % ALIGNMENT)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        start = f.tell()
+        for name, tensor in tensors.items():
+            f.seek(start + header[name]['data_offsets'][0])
+            f.write(tensor.view(-1).view(torch.uint8).numpy().tobytes() if tensor.numel() > 0 else b'')
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_weights(path):
+    """
+    以copy-on-write方式memmap打开safetensors文件, 返回的张量直接指向页缓存(零拷贝), 多个进程共享同一份物理内存
+    """
+    with open(path, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_len)
+    state_dict = OrderedDict()
+    for name, info in header.items():
+        if name == '__metadata__':
+            continue
+        begin, end = info['data_offsets']
+        raw = torch.from_numpy(data[begin:end]) if end > begin else torch.zeros(0, dtype=torch.uint8)
+        state_dict[name] = raw.view(TORCH_DTYPES[info['dtype']]).reshape(info['shape'])
+    return state_dict
+
+
+def to_adapter_layout(state_dict, embed_dim=768):
+    """timm的ViT权重 -> convs/adapter.py的布局: qkv拆为q_proj/k_proj/v_proj, mlp.fc1/fc2 改名为 fc1/fc2"""
+    converted = OrderedDict()
+    for key, value in state_dict.items():
+        if 'qkv.weight' in key or 'qkv.bias' in key:
+            suffix = 'weight' if key.endswith('weight') else 'bias'
+            for i, proj in enumerate(('q_proj', 'k_proj', 'v_proj')):
+                converted[key.replace('qkv.' + suffix, proj + '.' + suffix)] = value[embed_dim * i: embed_dim * (i + 1)].clone()
+        elif 'mlp.fc' in key:
+            converted[key.replace('mlp.', '')] = value
+        else:
+            converted[key] = value
+    return converted
+
+
+LAYOUTS = {
+    'timm': lambda state_dict: state_dict,
+    'adapter': to_adapter_layout,
+}
+
+
+def weight_path(model_name, layout='timm', root=None):
+    return os.path.join(root or DEFAULT_ROOT, '{}.{}.safetensors'.format(model_name, layout))
+
+
+def pretrained_state_dict(model_name, layout='timm', root=None):
+    """
+    不含分类头(num_classes=0)的预训练权重, 已转换为layout对应的布局
+    本地没有时从timm下载并转换一次写入注册目录, 之后直接memmap读取, 可离线使用
+    """
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown weight layout {}.".format(layout))
+    path = weight_path(model_name, layout, root)
+    if not os.path.exists(path):
+        import timm
+        checkpoint_model = timm.create_model(model_name, pretrained=True, num_classes=0)
+        save_weights(LAYOUTS[layout](checkpoint_model.state_dict()), path)
+        del checkpoint_model
+    return load_weights(path)
+
+
+def load_into(model, state_dict, strict=True):
+    """load_state_dict, 支持时用assign=True直接挂上memmap张量而不拷贝"""
+    try:
+        return model.load_state_dict(state_dict, strict=strict, assign=True)
+    except TypeError:
+        return model.load_state_dict(state_dict, strict=strict)
+
+
+def create_model(model_name, root=None):
+    """从注册目录构建不含分类头的timm模型, 等价于 timm.create_model(model_name, pretrained=True, num_classes=0)"""
+    import timm
+    model = timm.create_model(model_name, pretrained=False, num_classes=0)
+    load_into(model, pretrained_state_dict(model_name, root=root))
+    return model
+
+
+def benchmark(model_name='vit_base_patch16_224', root=None, repeats=3):
+    """比较 timm pretrained=True 与注册目录memmap加载的冷启动耗时(秒)"""
+    import timm
+
+    def timed(fn):
+        costs = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fn()
+            costs.append(time.perf_counter() - start)
+        return min(costs)
+
+    pretrained_state_dict(model_name, root=root)    # 确保已转换
+    return {
+        'timm_pretrained': timed(lambda: timm.create_model(model_name, pretrained=True, num_classes=0)),
+        'registry': timed(lambda: create_model(model_name, root=root)),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert pretrained checkpoints into the local weight registry.')
+    parser.add_argument('models', nargs='*', default=['vit_base_patch16_224', 'vit_base_patch16_224_in21k'])
+    parser.add_argument('--root', type=str, default=None)
+    parser.add_argument('--benchmark', action='store_true', help='report cold-start time against timm pretrained=True')
+    cli = parser.parse_args()
+
+    for name in cli.models:
+        for layout in LAYOUTS:
+            pretrained_state_dict(name, layout, cli.root)
+            print(f'{name} [{layout}] -> {weight_path(name, layout, cli.root)}')
+        if cli.benchmark:
+            for method, cost in benchmark(name, cli.root).items():
+                print(f'{name} {method:>16s}: {cost:.3f}s')